@@ -1,13 +1,21 @@
 import csv
 import logging
 import os
+import sys
 
 import elasticsearch
 import ruamel.yaml as yaml
 
 
+BASEDIR = os.path.dirname(__file__)
 CONTEXT_TIMEOUT = "1m"
 SCROLL_BATCH_SIZE = 5000
+SCROLL_PREFETCH_PAGES = 4
+SENTIMENT_ANALYZER_PATH = os.path.join(BASEDIR, "..", "sentiment-analyzer")
+
+sys.path.append(SENTIMENT_ANALYZER_PATH)
+
+import scroll_reader
 
 
 def get_documents(db, dump_task):
@@ -28,17 +36,19 @@ def get_documents(db, dump_task):
         },
     )
     
-    scroll_id = response["_scroll_id"]
     cur_count = response["hits"]["total"]
     
     logger.info("Streaming {} documents ...".format(cur_count))
     fetched_count = 0
     processed_count = 0
     
-    while cur_count > 0:
-        response = db.scroll(scroll_id=scroll_id, scroll=CONTEXT_TIMEOUT)
+    if not cur_count:
+        return
+    
+    pages = scroll_reader.get_scroll_pages(db, response, CONTEXT_TIMEOUT, SCROLL_PREFETCH_PAGES)
+    
+    for response in pages:
         cur_count = len(response["hits"]["hits"])
-        scroll_id = response["_scroll_id"]
         
         fetched_count += cur_count
         progress = fetched_count / response["hits"]["total"] * 100
@@ -73,6 +83,7 @@ def get_documents(db, dump_task):
             
             if processed_count >= dump_task["max_documents"]:
                 logger.debug("Reached max document count ({}), finishing.".format(processed_count))
+                pages.close()
                 return
 
 
@@ -0,0 +1,236 @@
+import argparse
+import collections
+import csv
+import logging
+import multiprocessing
+import time
+
+import numpy
+
+import price_predictor
+
+
+MAX_GRID_CELLS = 10000000
+REPORT_SIZE = 10
+SYNTHETIC_SEED = 42
+
+# One row per configuration. A hit is a predicted move in the direction of
+# the next trading day's mean price. The errors are mean absolute errors
+# against that price, baseline_error is the error of predicting no change.
+BacktestResult = collections.namedtuple("BacktestResult", (
+    "ticker_symbol",
+    "classifier",
+    "window",
+    "threshold",
+    "move",
+    "signals",
+    "hit_rate",
+    "mean_error",
+    "baseline_error",
+))
+
+
+def get_grid(config):
+    # start, stop and step per parameter, stop included.
+    grid = config["backtest"]
+
+    def get_range(start, stop, step):
+        return numpy.arange(start, stop + step / 2, step)
+
+    windows = get_range(*grid["windows"]).astype(numpy.int64)
+    thresholds = get_range(*grid["thresholds"])
+    moves = get_range(*grid["moves"])
+
+    return windows, thresholds, moves
+
+
+def get_logger():
+    logger = logging.getLogger("psais.backtester")
+    logger.setLevel(logging.DEBUG)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def get_results(trading_days, grid, workers):
+    windows, thresholds, moves = grid
+    tasks = [(trading_days, window, thresholds, moves) for window in windows.tolist()]
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            window_results = pool.map(get_window_results, tasks)
+    else:
+        window_results = map(get_window_results, tasks)
+
+    return [result for results in window_results for result in results]
+
+
+def get_synthetic_trading_days(days):
+    # A random walk for the price whose moves follow the sentiment change
+    # of the day before a little, so there is something to find.
+    random = numpy.random.RandomState(SYNTHETIC_SEED)
+    sentiments = numpy.clip(0.5 + random.normal(0, 0.1, days), 0, 1)
+    changes = numpy.concatenate(([0.0, 0.0], numpy.diff(sentiments)[:-1]))
+    prices = 100 * numpy.cumprod(1 + 0.02 * changes + random.normal(0, 0.01, days))
+
+    return price_predictor.TradingDays(
+        days=numpy.arange(days, dtype=numpy.int64),
+        prices=prices,
+        sentiments=sentiments,
+    )
+
+
+def get_window_results(task):
+    """Evaluates every threshold and move for one window length.
+
+    Mirrors price_predictor.get_predictions(): the mean sentiment of a day
+    is compared with the mean of the window days before it. Runs in a worker
+    process for large grids.
+    """
+    trading_days, window, thresholds, moves = task
+    prices = trading_days.prices
+    sentiments = trading_days.sentiments
+
+    # Days with at least one day before them and one after them.
+    idx = numpy.arange(1, len(prices) - 1)
+
+    if not len(idx):
+        return []
+
+    cumsum = numpy.concatenate(([0.0], numpy.cumsum(sentiments)))
+    starts = numpy.maximum(idx - window, 0)
+    changes = sentiments[idx] - (cumsum[idx] - cumsum[starts]) / (idx - starts)
+
+    current = prices[idx]
+    actual = prices[idx + 1]
+    actual_moves = numpy.sign(actual - current)
+    baseline_error = numpy.abs(current - actual).mean()
+
+    # (thresholds x days) signals of -1, 0 or 1, like get_predicted_price().
+    signals = (changes > thresholds[:, None]).astype(numpy.int8) - (changes < -thresholds[:, None])
+    active = signals != 0
+    signal_counts = active.sum(axis=1)
+    hits = ((signals == actual_moves) & active).sum(axis=1)
+
+    # The (thresholds x moves x days) errors are computed in blocks of
+    # thresholds to bound the memory use.
+    block_size = max(1, MAX_GRID_CELLS // (len(moves) * len(idx)))
+    mean_errors = numpy.empty((len(thresholds), len(moves)))
+
+    for start in range(0, len(thresholds), block_size):
+        block = signals[start:start + block_size]
+        predicted = current * (1 + moves[None, :, None] * block[:, None, :])
+        mean_errors[start:start + block_size] = numpy.abs(predicted - actual).mean(axis=2)
+
+    hit_rates = numpy.divide(hits, signal_counts, out=numpy.zeros(len(thresholds)), where=signal_counts > 0)
+    results = []
+
+    for threshold_idx, threshold in enumerate(thresholds.tolist()):
+        for move_idx, move in enumerate(moves.tolist()):
+            results.append(BacktestResult(
+                ticker_symbol=None,
+                classifier=None,
+                window=window,
+                threshold=threshold,
+                move=move,
+                signals=int(signal_counts[threshold_idx]),
+                hit_rate=float(hit_rates[threshold_idx]),
+                mean_error=float(mean_errors[threshold_idx, move_idx]),
+                baseline_error=float(baseline_error),
+            ))
+
+    return results
+
+
+def log_results(results):
+    ranked = sorted(results, key=lambda x: (-x.hit_rate, x.mean_error))
+
+    for result in ranked[:REPORT_SIZE]:
+        logger.info("{} {}: window {:>3}, threshold {:.4f}, move {:.4f}: {:>5} signals, hit rate {:.3f}, error {:.4f} (no change: {:.4f})".format(
+            result.ticker_symbol,
+            result.classifier,
+            result.window,
+            result.threshold,
+            result.move,
+            result.signals,
+            result.hit_rate,
+            result.mean_error,
+            result.baseline_error,
+        ))
+
+
+def save_to_csv(results, destination):
+    with open(destination, "w", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(BacktestResult._fields)
+        writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--local", action="store_true", help="bucket scrolls over prices and sentiments in-process instead of date_histograms")
+    parser.add_argument("--prices-csv", help="replay the prices of an es-dumper CSV file")
+    parser.add_argument("--sentiments-csv", help="replay the sentiments of an es-dumper CSV file")
+    parser.add_argument("--synthetic", type=int, metavar="DAYS", help="replay a generated fixture of this many trading days")
+    parser.add_argument("-o", "--output", help="write the results of all configurations to this CSV file")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="evaluate the window lengths in this many processes")
+
+    args = parser.parse_args()
+
+    config = price_predictor.get_config()
+    logger.setLevel(config["log_level"])
+    grid = get_grid(config)
+
+    if args.synthetic:
+        series_trading_days = {
+            price_predictor.Series(ticker_symbol="SYNTHETIC", classifier="synthetic"): get_synthetic_trading_days(args.synthetic),
+        }
+    else:
+        if args.prices_csv and args.sentiments_csv:
+            db = None
+        else:
+            db = price_predictor.get_database(config["database"]["host"])
+
+        prices, sentiments = price_predictor.get_aggregated_series(db, config, args)
+        series_trading_days = {
+            price_predictor.Series(ticker_symbol=ticker_symbol, classifier=classifier): price_predictor.get_trading_day_buckets(
+                price_predictor.get_merged_aggregations(prices[ticker_symbol], sentiments[classifier]),
+            )
+            for ticker_symbol in prices
+            for classifier in sentiments
+        }
+
+    all_results = []
+
+    for series, trading_days in series_trading_days.items():
+        start = time.perf_counter()
+        results = get_results(trading_days, grid, args.workers)
+        results = [result._replace(**series._asdict()) for result in results]
+
+        logger.info("Evaluated {} configurations over {} trading days of {} {} in {:.2f} s".format(
+            len(results),
+            len(trading_days.days),
+            series.ticker_symbol,
+            series.classifier,
+            time.perf_counter() - start,
+        ))
+
+        log_results(results)
+        all_results.extend(results)
+
+    if args.output:
+        logger.info("Writing {} results to {} ...".format(len(all_results), args.output))
+        save_to_csv(all_results, args.output)
+
+
+logger = get_logger()
+
+if __name__ == "__main__":
+    main()
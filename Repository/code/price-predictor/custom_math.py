@@ -1,3 +1,10 @@
+import bisect
+import collections
+import math
+
+import numpy
+
+
 def mean(numbers):
     return sum(numbers) / len(numbers)
 
@@ -7,10 +14,91 @@ def median(numbers):
 
 
 def percentile(numbers, percentage):
-    numbers = sorted(numbers)
+    # Selects the value without sorting everything, same index as before.
+    numbers = numpy.asarray(numbers)
     count = len(numbers)
-    
+
     idx = count * percentage / 100
     idx = int(idx)
-    
-    return numbers[idx]
+
+    return numpy.partition(numbers, idx)[idx].item()
+
+
+class RunningStats:
+    """Mean and variance of all values added so far.
+
+    Uses Welford's algorithm, so every update is O(1) and numerically stable.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    def stddev(self):
+        return math.sqrt(self.variance())
+
+
+class Ewma:
+    """Exponentially weighted moving average, the first value starts it."""
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    def add(self, value):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+
+        return self.value
+
+
+class RollingWindow:
+    """The last size values added.
+
+    The mean is kept as a running sum and the values are kept sorted on
+    insert, so the window is never sorted again to look up a percentile.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("Window size must be at least 1, got {}".format(size))
+
+        self.size = size
+        self.values = collections.deque()
+        self.sorted_values = []
+        self.sum = 0.0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        if len(self.values) == self.size:
+            old_value = self.values.popleft()
+            self.sum -= old_value
+            del self.sorted_values[bisect.bisect_left(self.sorted_values, old_value)]
+
+        self.values.append(value)
+        self.sum += value
+        bisect.insort(self.sorted_values, value)
+
+    def mean(self):
+        return self.sum / len(self.values)
+
+    def median(self):
+        return self.percentile(50)
+
+    def percentile(self, percentage):
+        idx = len(self.sorted_values) * percentage / 100
+        return self.sorted_values[int(idx)]
@@ -1,24 +1,120 @@
+import argparse
 import collections
 import datetime
+import json
 import logging
+import multiprocessing
 import os
 import pprint
+import sys
+import time
 
 import elasticsearch
-import elasticsearch.helpers
+import numpy
 import ruamel.yaml as yaml
 
 import custom_math
 
 
 ANALYSIS_DAYS = 3
+BASEDIR = os.path.dirname(__file__)
+BENCHMARK_DAYS = 250
+BENCHMARK_EXPAND_MINUTES = 2
+BENCHMARK_INDEX_NAME = "predictions_benchmark"
+DAY_MILLIS = 24 * 60 * 60 * 1000
 DOCUMENT_TYPE = "prediction"
+EMPTY_RESPONSE = {"aggregations": {"by_time": {"buckets": []}}}
+EPOCH = datetime.datetime(1970, 1, 1)
+HOUR_MILLIS = 60 * 60 * 1000
 INDEX_NAME = "predictions"
 INSERT_CHUNK_SIZE = 2500
+MILLISECOND = datetime.timedelta(milliseconds=1)
 NYSE_TRADE_END_HOUR = 20
 NYSE_UTC_OFFSET = datetime.timedelta(hours=-6)
+PRICE_DOCUMENT_TYPE = "stock_price"
+PRICE_INDEX_NAME = "stock_data"
+SENTIMENT_ANALYZER_PATH = os.path.join(BASEDIR, "..", "sentiment-analyzer")
+SENTIMENT_DOCUMENT_TYPE = "sentiment"
+SENTIMENT_INDEX_NAME = "sentiments"
 TIMEOUT = 60
 
+# Columns of equal length: epoch millis (int64) and float64 values.
+MergedSeries = collections.namedtuple("MergedSeries", ("dates", "prices", "sentiments"))
+Search = collections.namedtuple("Search", ("kind", "key", "index", "doc_type", "body"))
+Series = collections.namedtuple("Series", ("ticker_symbol", "classifier"))
+TimeSeries = collections.namedtuple("TimeSeries", ("dates", "values"))
+TradingDays = collections.namedtuple("TradingDays", ("days", "prices", "sentiments"))
+
+sys.path.append(SENTIMENT_ANALYZER_PATH)
+
+import bulk_writer
+import local_aggregator
+
+
+def benchmark_storage(db, days=BENCHMARK_DAYS):
+    # Synthetic predictions for a single series, saved once per layout.
+    series = Series(ticker_symbol="BENCHMARK", classifier="benchmark")
+    first_day = datetime.date(2016, 1, 1)
+    predictions = tuple(
+        {
+            "day": first_day + datetime.timedelta(days=idx),
+            "change": 0.1,
+            "price": 100.0,
+            "predicted_price": 101.0 if idx % 2 else 99.0,
+        }
+        for idx in range(days)
+    )
+    
+    if not db.ping():
+        logger.warning("Database not reachable, only measuring the generated documents")
+        db = None
+    
+    for name, expand_minutes in (("compact", None), ("dense", BENCHMARK_EXPAND_MINUTES)):
+        index = "{}_{}".format(BENCHMARK_INDEX_NAME, name)
+        start = time.perf_counter()
+        count = 0
+        payload_bytes = 0
+        
+        def get_actions():
+            nonlocal count, payload_bytes
+            
+            for document in get_prediction_documents(((series, predictions),), expand_minutes):
+                count += 1
+                payload_bytes += len(json.dumps(document, default=str))
+                yield get_save_action(document, index)
+        
+        if db is None:
+            collections.deque(get_actions(), maxlen=0)
+            logger.info("{}: {} documents, {} KiB payload, generated in {:.2f} s".format(
+                name,
+                count,
+                payload_bytes // 1024,
+                time.perf_counter() - start,
+            ))
+            continue
+        
+        try:
+            db.indices.delete(index=index)
+        except elasticsearch.exceptions.NotFoundError:
+            pass
+        
+        bulk_writer.bulk(db, get_actions(), chunk_size=INSERT_CHUNK_SIZE)
+        duration = time.perf_counter() - start
+        
+        db.indices.refresh(index=index)
+        db.indices.flush(index=index)
+        stats = db.indices.stats(index=index, metric="store")
+        size_bytes = stats["indices"][index]["primaries"]["store"]["size_in_bytes"]
+        db.indices.delete(index=index)
+        
+        logger.info("{}: {} documents, {} KiB payload, written in {:.2f} s, {} KiB on disk".format(
+            name,
+            count,
+            payload_bytes // 1024,
+            duration,
+            size_bytes // 1024,
+        ))
+
 
 def clear_index(db):
     try:
@@ -48,48 +144,65 @@ def get_aggregation_body(config, field):
     }
 
 
-def get_aggregated_prices(db, config):
-    logger.debug("Fetching aggregations ...")
+def get_aggregated_series(db, config, args):
+    """Returns the price aggregations per ticker symbol and the sentiment
+    aggregations per classifier.
     
-    response = db.search(
-        index="stock_data",
-        doc_type="stock_price",
-        body=get_aggregation_body(config, "price"),
-    )
+    Everything that isn't bucketed locally is fetched with one multi search.
+    """
+    searches = get_searches(config)
+    responses = get_search_responses(db, args, searches)
     
-    for doc_group in response["aggregations"]["by_time"]["buckets"]:
-        if not doc_group["avg_value"]["value"]:
-            logger.info("Skipping empty value for {}".format(doc_group["key_as_string"]))
-            continue
+    prices = collections.OrderedDict()
+    sentiments = collections.OrderedDict()
+    
+    for search, response in zip(searches, responses):
+        aggregations = get_aggregated_values(response)
+        logger.debug("Got {} {} aggregations for {}".format(len(aggregations.dates), search.kind, search.key))
         
-        aggregation = {
-            "date": doc_group["key_as_string"],
-            "value": doc_group["avg_value"]["value"],
-        }
+        if not len(aggregations.dates):
+            logger.warning("No {} aggregations for {}, there are no predictions for it".format(search.kind, search.key))
         
-        yield aggregation
+        if search.kind == "price":
+            prices[search.key] = aggregations
+        else:
+            sentiments[search.key] = aggregations
+    
+    return prices, sentiments
 
 
-def get_aggregated_sentiments(db, config):
-    logger.debug("Fetching aggregations ...")
-    
-    response = db.search(
-        index="sentiments",
-        doc_type="sentiment",
-        body=get_aggregation_body(config, "sentiment_relation"),
+def get_aggregated_values(response):
+    buckets = response["aggregations"]["by_time"]["buckets"]
+    dates = numpy.fromiter((bucket["key"] for bucket in buckets), dtype=numpy.int64, count=len(buckets))
+    values = numpy.fromiter(
+        (bucket["avg_value"]["value"] or 0.0 for bucket in buckets),
+        dtype=numpy.float64,
+        count=len(buckets),
     )
     
-    for doc_group in response["aggregations"]["by_time"]["buckets"]:
-        if not doc_group["avg_value"]["value"]:
-            logger.info("Skipping empty value for {}".format(doc_group["key_as_string"]))
-            continue
-        
-        aggregation = {
-            "date": doc_group["key_as_string"],
-            "value": doc_group["avg_value"]["value"],
-        }
-        
-        yield aggregation
+    # Empty buckets have no average, zero is not a usable value either.
+    valid = values != 0
+    
+    if not valid.all():
+        logger.info("Skipping {} empty values".format(len(values) - int(valid.sum())))
+    
+    return TimeSeries(dates=dates[valid], values=values[valid])
+
+
+def get_all_series_predictions(prices, sentiments, workers, analysis_days=ANALYSIS_DAYS):
+    tasks = [
+        (Series(ticker_symbol=ticker_symbol, classifier=classifier), prices[ticker_symbol], sentiments[classifier], analysis_days)
+        for ticker_symbol in prices
+        for classifier in sentiments
+    ]
+    
+    logger.info("Predicting {} series ...".format(len(tasks)))
+    
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            return tuple(pool.imap(get_series_predictions, tasks))
+    
+    return tuple(map(get_series_predictions, tasks))
 
 
 def get_config():
@@ -113,6 +226,40 @@ def get_database(host):
     return db
 
 
+def get_expanded_documents(document, interval_minutes):
+    # The former dense layout, one point every interval_minutes over the
+    # day, for dashboards that can't draw one value across a whole day.
+    fields = ("ticker_symbol", "classifier", "predicted_price_pos", "predicted_price_neg")
+    values = {field: document[field] for field in fields if field in document}
+    interval = datetime.timedelta(minutes=interval_minutes)
+    date = document["date"]
+    end = date + datetime.timedelta(days=1)
+    
+    while date < end:
+        expanded = {
+            "_id": "{}:{}:{}".format(document["ticker_symbol"], document["classifier"], date.isoformat()),
+            "date": date,
+        }
+        
+        expanded.update(values)
+        yield expanded
+        
+        date += interval
+
+
+def get_local_rows(db, args, search):
+    filename = args.prices_csv if search.kind == "price" else args.sentiments_csv
+    
+    if filename:
+        logger.info("Reading {} ...".format(filename))
+        return local_aggregator.get_csv_rows(filename)
+    
+    if args.local:
+        return local_aggregator.get_scroll_rows(db, search.index, search.doc_type, search.body)
+    
+    return None
+
+
 def get_logger():
     logger = logging.getLogger("psais.pricepredictor")
     logger.setLevel(logging.DEBUG)
@@ -129,44 +276,39 @@ def get_logger():
 
 
 def get_merged_aggregations(prices, sentiments):
-    merged = {}
-    
-    for price in prices:
-        if price["date"] in merged:
-            merged[price["date"]]["price"] = price["value"]
-        else:
-            merged[price["date"]] = {
-                "price": price["value"],
-            }
+    # Only dates with both a price and a sentiment are used. Bucket keys are
+    # unique, so the intersection keeps the ascending date order.
+    dates, price_idx, sentiment_idx = numpy.intersect1d(
+        prices.dates,
+        sentiments.dates,
+        assume_unique=True,
+        return_indices=True,
+    )
     
-    for sentiment in sentiments:
-        if sentiment["date"] in merged:
-            merged[sentiment["date"]]["sentiment"] = sentiment["value"]
-        else:
-            merged[sentiment["date"]] = {
-                "sentiment": sentiment["value"],
-            }
+    return MergedSeries(
+        dates=dates,
+        prices=prices.values[price_idx],
+        sentiments=sentiments.values[sentiment_idx],
+    )
+
+
+def get_multi_search_responses(db, searches):
+    logger.debug("Fetching {} aggregations ...".format(len(searches)))
+    body = []
     
-    def merge_dict_item(item):
-        date = get_parsed_elasticsearch_time(item[0])
-        
-        result = {
-            "date": date,
-        }
-        
-        result.update(item[1])
-        return result
+    for search in searches:
+        body.append({"index": search.index, "type": search.doc_type})
+        body.append(search.body)
     
-    complete_objects = merged.items()
-    complete_objects = map(merge_dict_item, complete_objects)
-    complete_objects = filter(lambda x: "price" in x and "sentiment" in x, complete_objects)
-    complete_objects = sorted(complete_objects, key=lambda x: x["date"])
+    response = db.msearch(body=body)
     
-    return complete_objects
-
-
-def get_parsed_elasticsearch_time(formatted_time):
-    return datetime.datetime.strptime(formatted_time, "%Y-%m-%dT%H:%M:%S.%fZ")
+    for search, search_response in zip(searches, response["responses"]):
+        if "error" in search_response:
+            logger.error("Cannot fetch {} aggregations for {}: {}".format(search.kind, search.key, search_response["error"]))
+            yield EMPTY_RESPONSE
+            continue
+        
+        yield search_response
 
 
 def get_predicted_price(price, diff):
@@ -178,40 +320,85 @@ def get_predicted_price(price, diff):
         return price
 
 
-def get_predictions(trading_days):
-    prev_day_means = ()
+def get_prediction_document(series, prediction):
+    # One document per series and trading day. It is dated at the start of
+    # the day, dashboards draw it over the whole day with a 1d interval.
+    date = datetime.datetime.combine(prediction["day"], datetime.time())
     
-    for day, trading_day in trading_days.items():
-        prices = tuple(map(lambda x: x["price"], trading_day))
-        sentiments = tuple(map(lambda x: x["sentiment"], trading_day))
-        mean_day = custom_math.mean(sentiments)
-        
+    document = {
+        "_id": "{}:{}:{}".format(series.ticker_symbol, series.classifier, prediction["day"].isoformat()),
+        "date": date,
+        "ticker_symbol": series.ticker_symbol,
+        "classifier": series.classifier,
+        "change": prediction["change"],
+        "price": prediction["price"],
+        "predicted_price": prediction["predicted_price"],
+    }
+    
+    diff = prediction["predicted_price"] - prediction["price"]
+    
+    if diff > 0:
+        document["predicted_price_pos"] = prediction["predicted_price"]
+    elif diff < 0:
+        document["predicted_price_neg"] = prediction["predicted_price"]
+    
+    return document
+
+
+def get_prediction_documents(series_predictions, expand_minutes=None):
+    for series, predictions in series_predictions:
+        for prediction in predictions:
+            document = get_prediction_document(series, prediction)
+            
+            if expand_minutes:
+                yield from get_expanded_documents(document, expand_minutes)
+            else:
+                yield document
+
+
+def get_predictions(trading_days, analysis_days=ANALYSIS_DAYS):
+    # Compares the mean sentiment of every day with the mean of the
+    # analysis_days days before it.
+    prev_day_means = custom_math.RollingWindow(analysis_days)
+    
+    days = trading_days.days.tolist()
+    price_means = trading_days.prices.tolist()
+    sentiment_means = trading_days.sentiments.tolist()
+    
+    for day, prices_mean, mean_day in zip(days, price_means, sentiment_means):
         if not prev_day_means: # Special handling for first item.
-            prev_day_means = (mean_day,)
+            prev_day_means.add(mean_day)
             continue
         
-        mean_prev_days = custom_math.mean(prev_day_means)
-        
-        prev_day_means = (mean_day,) + prev_day_means
-        prev_day_means = prev_day_means[:ANALYSIS_DAYS]
+        mean_prev_days = prev_day_means.mean()
+        prev_day_means.add(mean_day)
         
         sentiment_diff = mean_day - mean_prev_days
-        
-        prices_mean = custom_math.mean(prices)
         predicted_price = get_predicted_price(prices_mean, sentiment_diff)
         
         yield {
-            "day": day,
+            "day": EPOCH.date() + datetime.timedelta(days=day),
             "change": sentiment_diff,
             "price": prices_mean,
             "predicted_price": predicted_price,
         }
 
 
-def get_save_action(document):
+def get_price_body(config, ticker_symbol):
+    body = get_aggregation_body(config, "price")
+    body["query"] = {
+        "match_phrase": {
+            "ticker_symbol": ticker_symbol,
+        },
+    }
+    
+    return body
+
+
+def get_save_action(document, index=INDEX_NAME):
     action = {
         "_op_type": "index",
-        "_index": INDEX_NAME,
+        "_index": index,
         "_type": DOCUMENT_TYPE,
     }
     
@@ -219,71 +406,143 @@ def get_save_action(document):
     return action
 
 
-def get_trading_day_buckets(aggregations):
-    result = collections.OrderedDict()
+def get_search_responses(db, args, searches):
+    rows = [get_local_rows(db, args, search) for search in searches]
+    remote_searches = [search for search, search_rows in zip(searches, rows) if search_rows is None]
     
-    for aggregation in aggregations:
-        day = aggregation["date"] + NYSE_UTC_OFFSET
-        
-        if day.hour >= NYSE_TRADE_END_HOUR:
-            day = day + datetime.timedelta(days=1)
-        
-        day = day.date()
-        
-        items = result.setdefault(day, [])
-        items.append(aggregation)
+    if remote_searches:
+        remote_responses = get_multi_search_responses(db, remote_searches)
+    else:
+        remote_responses = iter(())
     
-    return result
+    for search, search_rows in zip(searches, rows):
+        if search_rows is None:
+            yield next(remote_responses)
+        else:
+            logger.debug("Aggregating {} for {} locally ...".format(search.kind, search.key))
+            yield local_aggregator.search(search_rows, search.body)
 
 
-def save_predictions(db, predictions):
-    documents = []
+def get_searches(config):
+    searches = []
     
-    for prediction in predictions:
-        for hour in range(24):
-            for minute in range(0, 60, 2):
-                time = datetime.time(hour=hour, minute=minute)
-                date = datetime.datetime.combine(prediction["day"], time)
-                
-                document = {
-                    "date": date,
-                }
-                
-                diff = prediction["predicted_price"] - prediction["price"]
-                
-                if diff > 0:
-                    document["predicted_price_pos"] = prediction["predicted_price"]
-                elif diff < 0:
-                    document["predicted_price_neg"] = prediction["predicted_price"]
-                
-                documents.append(document)
+    for ticker_symbol in config["ticker_symbols"]:
+        searches.append(Search(
+            kind="price",
+            key=ticker_symbol,
+            index=PRICE_INDEX_NAME,
+            doc_type=PRICE_DOCUMENT_TYPE,
+            body=get_price_body(config, ticker_symbol),
+        ))
+    
+    for classifier, field in config["classifiers"].items():
+        searches.append(Search(
+            kind="sentiment",
+            key=classifier,
+            index=SENTIMENT_INDEX_NAME,
+            doc_type=SENTIMENT_DOCUMENT_TYPE,
+            body=get_aggregation_body(config, field),
+        ))
     
+    return searches
+
+
+def get_series_predictions(task):
+    # Runs in a worker process when predicting with more than one.
+    series, prices, sentiments, analysis_days = task
+    
+    merged_aggregations = get_merged_aggregations(prices, sentiments)
+    trading_days = get_trading_day_buckets(merged_aggregations)
+    predictions = get_predictions(trading_days, analysis_days)
+    
+    predictions = filter(lambda x: x["price"] != x["predicted_price"], predictions)
+    return series, tuple(predictions)
+
+
+def get_trading_day_buckets(merged):
+    """Returns the mean price and sentiment per NYSE trading day.
+    
+    Days are counted from the epoch. Anything after the end of trading
+    belongs to the next day.
+    """
+    local_dates = merged.dates + NYSE_UTC_OFFSET // MILLISECOND
+    days = local_dates // DAY_MILLIS
+    hours = local_dates % DAY_MILLIS // HOUR_MILLIS
+    days += hours >= NYSE_TRADE_END_HOUR
+    
+    if not len(days):
+        return TradingDays(days=days, prices=merged.prices, sentiments=merged.sentiments)
+    
+    # Dates are sorted, so every day is one run of equal values.
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(days)) + 1))
+    counts = numpy.diff(numpy.append(starts, len(days)))
+    
+    return TradingDays(
+        days=days[starts],
+        prices=numpy.add.reduceat(merged.prices, starts) / counts,
+        sentiments=numpy.add.reduceat(merged.sentiments, starts) / counts,
+    )
+
+
+def save_predictions(db, series_predictions, expand_minutes=None):
+    documents = get_prediction_documents(series_predictions, expand_minutes)
     save_actions = map(get_save_action, documents)
-    elasticsearch.helpers.bulk(db, save_actions, chunk_size=INSERT_CHUNK_SIZE)
+    bulk_writer.bulk(db, save_actions, chunk_size=INSERT_CHUNK_SIZE)
+
+
+def save_to_file(series_predictions, destination):
+    with open(destination, "w") as fh:
+        for series, predictions in series_predictions:
+            for prediction in predictions:
+                document = dict(prediction, **series._asdict())
+                fh.write(json.dumps(document, default=str, sort_keys=True))
+                fh.write("\n")
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark-storage", action="store_true", help="compare writing compact and expanded predictions")
+    parser.add_argument("--local", action="store_true", help="bucket scrolls over prices and sentiments in-process instead of date_histograms")
+    parser.add_argument("--prices-csv", help="bucket the prices of an es-dumper CSV file in-process")
+    parser.add_argument("--sentiments-csv", help="bucket the sentiments of an es-dumper CSV file in-process")
+    parser.add_argument("-o", "--output", help="write the predictions to this file as JSON lines instead of saving them")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="predict the series in this many processes")
+    
+    args = parser.parse_args()
+    
     config = get_config()
     logger.setLevel(config["log_level"])
-    db = get_database(config["database"]["host"])
     
-    prices = get_aggregated_prices(db, config)
-    sentiments = get_aggregated_sentiments(db, config)
+    if args.benchmark_storage:
+        benchmark_storage(get_database(config["database"]["host"]))
+        return
     
-    merged_aggregations = get_merged_aggregations(prices, sentiments)
-    trading_days = get_trading_day_buckets(merged_aggregations)
-    predictions = get_predictions(trading_days)
+    if args.prices_csv and args.sentiments_csv and args.output:
+        # Offline replay, no cluster needed.
+        db = None
+    else:
+        db = get_database(config["database"]["host"])
     
-    predictions = filter(lambda x: x["price"] != x["predicted_price"], predictions)
-    predictions = tuple(predictions)
-    #pp.pprint(predictions)
+    prices, sentiments = get_aggregated_series(db, config, args)
+    series_predictions = get_all_series_predictions(
+        prices,
+        sentiments,
+        args.workers,
+        config.get("analysis_days", ANALYSIS_DAYS),
+    )
+    count = sum(len(predictions) for series, predictions in series_predictions)
+    #pp.pprint(series_predictions)
+    
+    if args.output:
+        logger.info("Writing {} predictions to {} ...".format(count, args.output))
+        save_to_file(series_predictions, args.output)
+        return
     
     logger.info("Deleting index {} ...".format(INDEX_NAME))
     clear_index(db)
     
-    logger.info("Saving {} predictions ...".format(len(predictions)))
-    save_predictions(db, predictions)
-    
+    logger.info("Saving {} predictions of {} series ...".format(count, len(series_predictions)))
+    save_predictions(db, series_predictions, config.get("expand_predictions_minutes"))
 
 
 logger = get_logger()
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import price_predictor
+
+
+CHUNK_SIZES = (1, 2, 100)
+CONFIG = {
+    "aggregation_interval_minutes": 60,
+}
+
+# Stock prices as the scraper stores them. The empty 14:00 bucket and the
+# quote without a price have no average.
+PRICES = (
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T13:10:00.123456", "price": 100.5},
+    {"ticker_symbol": "GOOG", "date": "2016-06-01T13:20:00.000000", "price": 700.0},
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T13:40:00.000000", "price": 101.0},
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T15:05:00.000000", "price": 102.25},
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T15:30:00.000000", "price": None},
+)
+
+# What Elasticsearch 2.x answers to get_price_body(CONFIG, "AAPL") over PRICES.
+PRICE_RESPONSE = {
+    "took": 2,
+    "timed_out": False,
+    "_shards": {"total": 5, "successful": 5, "failed": 0},
+    "hits": {"total": 4, "max_score": 0.0, "hits": []},
+    "aggregations": {
+        "by_time": {
+            "buckets": [
+                {"key_as_string": "2016-06-01T13:00:00.000Z", "key": 1464786000000, "doc_count": 2, "avg_value": {"value": 100.75}},
+                {"key_as_string": "2016-06-01T14:00:00.000Z", "key": 1464789600000, "doc_count": 0, "avg_value": {"value": None}},
+                {"key_as_string": "2016-06-01T15:00:00.000Z", "key": 1464793200000, "doc_count": 2, "avg_value": {"value": 102.25}},
+            ],
+        },
+    },
+}
+
+
+class AggregatedValuesTest(unittest.TestCase):
+    def test_local_search_matches_elasticsearch_response(self):
+        body = price_predictor.get_price_body(CONFIG, "AAPL")
+        expected = price_predictor.get_aggregated_values(PRICE_RESPONSE)
+
+        self.assertEqual(expected.dates.tolist(), [1464786000000, 1464793200000])
+        self.assertEqual(expected.values.tolist(), [100.75, 102.25])
+
+        for chunk_size in CHUNK_SIZES:
+            response = price_predictor.local_aggregator.search(iter(PRICES), body, chunk_size)
+            aggregations = price_predictor.get_aggregated_values(response)
+
+            self.assertEqual(response["aggregations"], PRICE_RESPONSE["aggregations"])
+            self.assertEqual(aggregations.dates.tolist(), expected.dates.tolist())
+            self.assertEqual(aggregations.values.tolist(), expected.values.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
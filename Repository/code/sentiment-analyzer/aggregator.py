@@ -1,15 +1,27 @@
+import argparse
+import json
 import logging
 import os
+import time
 
 import elasticsearch
-import elasticsearch.helpers
 import ruamel.yaml as yaml
 
+import bulk_writer
+import local_aggregator
+import sentiment_analyzer
 
+
+CLASSIFIED_LOOKBACK_MINUTES = 10
 DOCUMENT_TYPE = "sentiment"
 INDEX_NAME = "sentiments"
 INSERT_CHUNK_SIZE = 2500
+LOOKBACK_BUCKETS = 3
 TIMEOUT = 60
+TWEET_DOCUMENT_TYPE = "tweet"
+TWEET_INDEX_NAME = "twitter"
+WATERMARK_DOCUMENT_TYPE = "watermark"
+WATERMARK_ID = "aggregator"
 
 
 def clear_index(db):
@@ -19,8 +31,8 @@ def clear_index(db):
         pass
 
 
-def get_aggregation_body(config):
-    return {
+def get_aggregation_body(config, since=None):
+    body = {
         "size": 0,
         "aggs": {
             "by_time" : {
@@ -28,49 +40,84 @@ def get_aggregation_body(config):
                     "field" : "date",
                     "interval" : "{}m".format(config["aggregation"]["time_interval_minutes"]),
                 },
-                "aggs": {
-                    "by_sentiment" : {
-                        "terms" : {
-                            "script" : {
-                                "lang": "groovy",
-                                "file": "polarity_to_class",
-                                "params": {
-                                    "classifier": "naive_bayes"
-                                }
-                            }
-                        }
-                    }
-                }
+                "aggs": {}
             }
         }
     }
+    
+    for classifier in get_classifiers(config):
+        body["aggs"]["by_time"]["aggs"]["by_sentiment_{}".format(classifier)] = {
+            "terms" : {
+                "field": sentiment_analyzer.get_class_field(classifier),
+            }
+        }
+    
+    if since is not None:
+        body["query"] = {
+            "range": {
+                "date": {
+                    "gte": since,
+                    "format": "epoch_millis",
+                },
+            },
+        }
+    
+    return body
 
 
-def get_aggregated_documents(db, config):
-    logger.info("Sending aggregation request and waiting for results ...")
+def get_aggregated_documents(db, config, since=None, rows=None):
+    body = get_aggregation_body(config, since)
     
-    response = db.search(
-        index="twitter",
-        doc_type="tweet",
-        body=get_aggregation_body(config),
-    )
+    if rows is None:
+        logger.info("Sending aggregation request and waiting for results ...")
+        response = db.search(
+            index=TWEET_INDEX_NAME,
+            doc_type=TWEET_DOCUMENT_TYPE,
+            body=body,
+        )
+    else:
+        logger.info("Aggregating tweets locally ...")
+        response = local_aggregator.search(rows, body)
     
     logger.info("Parsing results ...")
+    classifiers = get_classifiers(config)
     
     for doc_group in response["aggregations"]["by_time"]["buckets"]:
         aggregation = {
             "date": doc_group["key_as_string"],
         }
         
-        for sentiment in doc_group["by_sentiment"]["buckets"]:
-            aggregation[sentiment["key"]] = sentiment["doc_count"]
-        
-        if "pos" in aggregation and "neg" in aggregation:
-            aggregation["sentiment_relation"] = aggregation["pos"] / (aggregation["pos"] + aggregation["neg"])
+        for classifier in classifiers:
+            counts = {}
+            
+            for sentiment in doc_group["by_sentiment_{}".format(classifier)]["buckets"]:
+                counts[sentiment["key"]] = sentiment["doc_count"]
+            
+            if "pos" in counts and "neg" in counts:
+                aggregation[get_relation_field(classifier)] = counts["pos"] / (counts["pos"] + counts["neg"])
+            
+            # The main classifier is saved under the plain names as well,
+            # which is what the dashboards show.
+            if classifier == config["classifier"]:
+                aggregation.update(counts)
+                
+                if get_relation_field(classifier) in aggregation:
+                    aggregation["sentiment_relation"] = aggregation[get_relation_field(classifier)]
         
         yield aggregation
 
 
+def get_classifiers(config):
+    # The main classifier first, then the others listed for aggregation.
+    classifiers = [config["classifier"]]
+    
+    for classifier in config["aggregation"].get("classifiers") or ():
+        if classifier not in classifiers:
+            classifiers.append(classifier)
+    
+    return classifiers
+
+
 def get_config():
     config_file = os.getenv("SENTIMENT_CONFIG", "config.yaml")
     config_file = os.path.abspath(config_file)
@@ -107,9 +154,16 @@ def get_logger():
     return logger
 
 
+def get_relation_field(classifier_name):
+    return "sentiment_relation_{}".format(classifier_name)
+
+
 def get_save_action(document):
+    # Buckets are identified by their date, so aggregating a bucket again
+    # replaces its document instead of adding another one.
     action = {
         "_op_type": "index",
+        "_id": document["date"],
         "_index": INDEX_NAME,
         "_type": DOCUMENT_TYPE,
     }
@@ -118,24 +172,194 @@ def get_save_action(document):
     return action
 
 
+def get_classified_since(db):
+    # Tweets are only visible once their bulk request is done, and the
+    # analyzer's clock may differ from ours, hence the lookback.
+    try:
+        response = db.get(index=INDEX_NAME, doc_type=WATERMARK_DOCUMENT_TYPE, id=WATERMARK_ID)
+    except elasticsearch.exceptions.NotFoundError:
+        return None
+    
+    return int(response["_source"]["classified_before"]) - CLASSIFIED_LOOKBACK_MINUTES * 60 * 1000
+
+
+def get_oldest_classified_date(db, classified_since):
+    response = db.search(
+        index=TWEET_INDEX_NAME,
+        doc_type=TWEET_DOCUMENT_TYPE,
+        body={
+            "size": 0,
+            "query": {
+                "range": {
+                    sentiment_analyzer.CLASSIFIED_AT_FIELD: {
+                        "gte": classified_since,
+                        "format": "epoch_millis",
+                    },
+                },
+            },
+            "aggs": {
+                "min_date": {
+                    "min": {
+                        "field": "date",
+                    },
+                },
+            },
+        },
+    )
+    
+    value = response["aggregations"]["min_date"]["value"]
+    return None if value is None else int(value)
+
+
+def get_since(db, config):
+    """Returns the start of the oldest bucket that may have changed since
+    the last run, or None if everything has to be aggregated.
+    
+    The newest saved bucket is the high-watermark. It and the buckets
+    before it may still have been incomplete during the last run. Tweets
+    classified since the last run may belong to any older bucket as well.
+    """
+    try:
+        response = db.search(
+            index=INDEX_NAME,
+            doc_type=DOCUMENT_TYPE,
+            body={
+                "size": 0,
+                "aggs": {
+                    "max_date": {
+                        "max": {
+                            "field": "date",
+                        },
+                    },
+                },
+            },
+        )
+    except elasticsearch.exceptions.NotFoundError:
+        return None
+    
+    watermark = response["aggregations"]["max_date"]["value"]
+    
+    if watermark is None:
+        return None
+    
+    interval_ms = config["aggregation"]["time_interval_minutes"] * 60 * 1000
+    since = int(watermark) - LOOKBACK_BUCKETS * interval_ms
+    
+    classified_since = get_classified_since(db)
+    
+    if classified_since is None:
+        return since
+    
+    oldest_date = get_oldest_classified_date(db, classified_since)
+    
+    if oldest_date is not None and oldest_date < since:
+        # Whole buckets only, the range query must not cut one in half.
+        logger.info("Tweets classified since the last run go back to {}".format(oldest_date))
+        since = oldest_date // interval_ms * interval_ms
+    
+    return since
+
+
+def get_tweet_rows(db, config, args, since):
+    if args.csv:
+        logger.info("Reading tweets from {} ...".format(args.csv))
+        return local_aggregator.get_csv_rows(args.csv)
+    
+    if args.local:
+        return local_aggregator.get_scroll_rows(
+            db,
+            TWEET_INDEX_NAME,
+            TWEET_DOCUMENT_TYPE,
+            get_aggregation_body(config, since),
+        )
+    
+    return None
+
+
 def save_aggregations(db, aggregations):
     save_actions = map(get_save_action, aggregations)
-    elasticsearch.helpers.bulk(db, save_actions, chunk_size=INSERT_CHUNK_SIZE)
+    return bulk_writer.bulk(db, save_actions, chunk_size=INSERT_CHUNK_SIZE)
+
+
+def save_watermark(db, classified_before):
+    db.index(
+        index=INDEX_NAME,
+        doc_type=WATERMARK_DOCUMENT_TYPE,
+        id=WATERMARK_ID,
+        body={
+            "classified_before": classified_before,
+        },
+    )
+
+
+def save_to_file(aggregations, destination):
+    with open(destination, "w") as fh:
+        for aggregation in aggregations:
+            fh.write(json.dumps(aggregation, sort_keys=True))
+            fh.write("\n")
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild", action="store_true", help="delete the index and aggregate all tweets again")
+    parser.add_argument("--local", action="store_true", help="bucket a scroll over the tweets in-process instead of a date_histogram")
+    parser.add_argument("--csv", help="bucket the tweets of an es-dumper CSV file in-process")
+    parser.add_argument("-o", "--output", help="write the aggregated documents to this file as JSON lines instead of saving them")
+    
+    args = parser.parse_args()
+    
     config = get_config()
     logger.setLevel(config["log_level"])
-    db = get_database(config["database"]["host"])
     
-    aggregations = get_aggregated_documents(db, config)
+    # Everything classified before the run started is aggregated by it.
+    start_millis = int(time.time() * 1000)
+    
+    if args.csv and args.output:
+        # Offline replay, no cluster needed.
+        db = None
+        since = None
+    else:
+        db = get_database(config["database"]["host"])
+        rebuild = args.rebuild
+        
+        # Indices saved before the watermark existed have documents with
+        # generated ids. Date ids would be added next to them and the
+        # dashboards would count those buckets twice, so they are rebuilt.
+        # Until a rebuild saves without errors there is no watermark, so
+        # the next run rebuilds again.
+        if not rebuild and not args.csv and not args.output and get_classified_since(db) is None:
+            logger.info("No watermark in {}, rebuilding it ...".format(INDEX_NAME))
+            rebuild = True
+        
+        if rebuild and not args.output:
+            logger.info("Deleting index {} ...".format(INDEX_NAME))
+            clear_index(db)
+            since = None
+        elif rebuild or args.csv:
+            since = None
+        else:
+            since = get_since(db, config)
+    
+    if since is None:
+        logger.info("Aggregating all tweets ...")
+    else:
+        logger.info("Aggregating tweets since {} ...".format(since))
+    
+    rows = get_tweet_rows(db, config, args, since)
+    aggregations = get_aggregated_documents(db, config, since, rows)
     aggregations = tuple(aggregations)
     
-    logger.info("Deleting index {} ...".format(INDEX_NAME))
-    clear_index(db)
+    if args.output:
+        logger.info("Writing {} aggregated values to {} ...".format(len(aggregations), args.output))
+        save_to_file(aggregations, args.output)
+        return
     
     logger.info("Saving {} aggregated values ...".format(len(aggregations)))
-    save_aggregations(db, aggregations)
+    success, errors = save_aggregations(db, aggregations)
+    
+    # After a failed save the next run has to cover this one's tweets again.
+    if not args.csv and not errors:
+        save_watermark(db, start_millis)
 
 
 logger = get_logger()
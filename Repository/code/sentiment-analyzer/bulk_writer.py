@@ -0,0 +1,199 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import time
+
+import elasticsearch
+import elasticsearch.helpers
+
+
+CHUNK_SIZE = 2500
+MAX_CHUNK_BYTES = 10 * 1024 * 1024
+MAX_CHUNK_SIZE = 20000
+MAX_IN_FLIGHT = 4
+MAX_RETRIES = 3
+MIN_CHUNK_SIZE = 100
+RETRY_DELAY_SECONDS = 2
+SIZE_SAMPLE_INTERVAL = 50
+TARGET_REQUEST_SECONDS = 1.0
+
+ChunkResult = collections.namedtuple("ChunkResult", ("count", "size_bytes", "success", "errors", "duration", "failed"))
+
+
+def bulk(db, actions, chunk_size=CHUNK_SIZE, max_in_flight=MAX_IN_FLIGHT):
+    """Sends the actions in bulk requests from a thread pool.
+
+    At most max_in_flight requests are pending at a time, so reading from
+    actions pauses while Elasticsearch is busy. Chunk sizes follow the
+    measured request latency and payload size, failed chunks and actions
+    rejected by a busy cluster are retried.
+    Returns the number of successful actions and a list of errors, like
+    elasticsearch.helpers.bulk() with raise_on_error=False.
+    """
+    success = 0
+    errors = []
+    in_flight = set()
+
+    def collect(done):
+        nonlocal chunk_size, success
+
+        for future in done:
+            result = future.result()
+            success += result.success
+            errors.extend(result.errors)
+            chunk_size = get_adapted_chunk_size(chunk_size, result)
+
+            logger.debug("Sent {} actions ({} KiB) in {:.2f} s, next chunk size {}".format(
+                result.count,
+                result.size_bytes // 1024,
+                result.duration,
+                chunk_size,
+            ))
+
+    with concurrent.futures.ThreadPoolExecutor(max_in_flight) as executor:
+        for chunk, size_bytes in get_chunks(actions, lambda: chunk_size):
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+
+            in_flight.add(executor.submit(send_chunk, db, chunk, size_bytes))
+
+        collect(concurrent.futures.wait(in_flight).done)
+
+    if errors:
+        logger.error("{} bulk actions failed, {} succeeded".format(len(errors), success))
+
+    return success, errors
+
+
+def get_adapted_chunk_size(chunk_size, result):
+    if result.failed:
+        return max(MIN_CHUNK_SIZE, chunk_size // 2)
+
+    if not result.count or not result.duration:
+        return chunk_size
+
+    # Grow or shrink towards TARGET_REQUEST_SECONDS, but at most by a
+    # factor of two per request so single slow requests don't dominate.
+    factor = TARGET_REQUEST_SECONDS / result.duration
+    factor = min(max(factor, 0.5), 2)
+
+    max_size_by_bytes = MAX_CHUNK_BYTES * result.count // max(result.size_bytes, 1)
+    new_size = int(result.count * factor)
+
+    return max(MIN_CHUNK_SIZE, min(new_size, max_size_by_bytes, MAX_CHUNK_SIZE))
+
+
+def get_chunks(actions, get_chunk_size):
+    # Payload sizes are estimated from every SIZE_SAMPLE_INTERVAL-th action,
+    # serializing all of them would cost about as much as sending them.
+    chunk = []
+    size_bytes = 0
+    sampled = 0
+    sampled_bytes = 0
+
+    for action in actions:
+        if len(chunk) % SIZE_SAMPLE_INTERVAL == 0:
+            sampled += 1
+            sampled_bytes += len(json.dumps(action, default=str))
+
+        chunk.append(action)
+        size_bytes = len(chunk) * sampled_bytes // sampled
+
+        if len(chunk) >= get_chunk_size() or size_bytes >= MAX_CHUNK_BYTES:
+            yield chunk, size_bytes
+            chunk = []
+            size_bytes = 0
+
+    if chunk:
+        yield chunk, size_bytes
+
+
+def get_logger():
+    logger = logging.getLogger("psais.bulkwriter")
+    logger.setLevel(logging.DEBUG)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def is_retryable(item):
+    # Bulk items look like {"update": {"status": 429, ...}}. Rejections of a
+    # busy cluster and server errors may work later, bad documents never.
+    op_type, result = next(iter(item.items()))
+    status = result.get("status", 500)
+
+    return status == 429 or status >= 500
+
+
+def send_chunk(db, chunk, size_bytes):
+    """Sends the chunk in one bulk request, retrying with backoff.
+
+    Failed requests are sent again in full, actions the cluster rejected
+    (429 and 5xx items) on their own. A chunk with rejected actions counts
+    as failed, so the next chunks are smaller.
+    """
+    success = 0
+    errors = []
+    failed = False
+    pending = chunk
+
+    for attempt in range(MAX_RETRIES + 1):
+        start = time.perf_counter()
+        delay = RETRY_DELAY_SECONDS * 2 ** attempt
+
+        try:
+            results = tuple(elasticsearch.helpers.streaming_bulk(
+                db,
+                pending,
+                chunk_size=len(pending),
+                raise_on_error=False,
+            ))
+        except elasticsearch.exceptions.ElasticsearchException as e:
+            if attempt == MAX_RETRIES:
+                logger.exception("Giving up on a chunk of {} actions".format(len(pending)))
+                errors.extend({"exception": repr(e), "action": action} for action in pending)
+                failed = True
+                break
+
+            logger.warning("Bulk request failed ({}), retrying in {} s ...".format(e, delay))
+            time.sleep(delay)
+            continue
+
+        rejected = []
+
+        for action, (ok, item) in zip(pending, results):
+            if ok:
+                success += 1
+            elif is_retryable(item) and attempt < MAX_RETRIES:
+                rejected.append(action)
+            else:
+                errors.append(item)
+
+        if not rejected:
+            break
+
+        logger.warning("{} bulk actions were rejected, retrying in {} s ...".format(len(rejected), delay))
+        failed = True
+        pending = rejected
+        time.sleep(delay)
+
+    return ChunkResult(
+        count=len(chunk),
+        size_bytes=size_bytes,
+        success=success,
+        errors=errors,
+        duration=time.perf_counter() - start,
+        failed=failed,
+    )
+
+
+logger = get_logger()
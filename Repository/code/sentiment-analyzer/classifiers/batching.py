@@ -0,0 +1,14 @@
+import itertools
+
+
+def get_batches(iterable, batch_size):
+    # Tuples of up to batch_size items, read from iterable only as needed.
+    iterator = iter(iterable)
+
+    while True:
+        batch = tuple(itertools.islice(iterator, batch_size))
+
+        if not batch:
+            return
+
+        yield batch
@@ -1 +1 @@
-from .naive_bayes import classify
+from .naive_bayes import classify, classify_many
@@ -0,0 +1,278 @@
+import collections
+import contextlib
+import os
+import pickle
+import struct
+
+import numpy
+
+
+# File layout: header, labels and vocabulary as newline separated UTF-8 text,
+# zero padding, then the float32 log-priors followed by the row major
+# (vocabulary x labels) log-likelihood matrix.
+MODEL_ALIGNMENT = 16
+MODEL_DTYPE = numpy.dtype("<f4")
+MODEL_HEADER = struct.Struct("<8sIIIQ")
+MODEL_MAGIC = b"PSAISNB\0"
+MODEL_VERSION = 1
+COUNTS_VERSION = 2
+
+# word_counts: occurrences per word (used to pick the vocabulary), word_sets:
+# sentences per label and distinct set of words. Like nltk, a sentence is
+# only trained on if one of its words makes it into the vocabulary, which
+# is only known once everything is counted.
+Counts = collections.namedtuple("Counts", ("word_counts", "word_sets"))
+Model = collections.namedtuple("Model", ("labels", "vocabulary", "log_priors", "log_likelihoods"))
+
+
+def get_empty_counts():
+    return Counts(
+        word_counts=collections.Counter(),
+        word_sets=collections.defaultdict(collections.Counter),
+    )
+
+
+def get_model_from_counts(counts, vocabulary_size):
+    # Same expected likelihood estimates nltk.NaiveBayesClassifier.train()
+    # uses for binary word features, computed straight from the counts.
+    words = [word for word, count in counts.word_counts.most_common(vocabulary_size)]
+    vocabulary = {word: idx for idx, word in enumerate(words)}
+
+    labels = []
+    label_totals = []
+    document_counts = []
+
+    for label in sorted(counts.word_sets):
+        label_total = 0
+        label_document_counts = numpy.zeros(len(words), dtype=numpy.float64)
+
+        for word_set, count in counts.word_sets[label].items():
+            ids = [vocabulary[word] for word in word_set if word in vocabulary]
+
+            if not ids:
+                continue
+
+            label_total += count
+            label_document_counts[ids] += count
+
+        if label_total:
+            labels.append(label)
+            label_totals.append(label_total)
+            document_counts.append(label_document_counts)
+
+    label_totals = numpy.array(label_totals, dtype=numpy.float64)
+    document_counts = numpy.array(document_counts, dtype=numpy.float64).T.reshape((len(words), len(labels)))
+
+    log_priors = numpy.log((label_totals + 0.5) / (label_totals.sum() + 0.5 * len(labels)))
+
+    # nltk only adds the "absent" bin for words that are missing from at
+    # least one sentence, which matters for words present in every one.
+    bins = 1 + (document_counts < label_totals).any(axis=1, keepdims=True)
+    log_likelihoods = numpy.log((document_counts + 0.5) / (label_totals + 0.5 * bins))
+
+    return Model(
+        labels=tuple(labels),
+        vocabulary=vocabulary,
+        log_priors=log_priors,
+        log_likelihoods=log_likelihoods,
+    )
+
+
+def get_model_from_nltk_classifier(classifier):
+    # nltk only ever sees {word: True} feature sets (see get_word_map), so the
+    # likelihood of a word being present is all we need per (label, word).
+    labels = tuple(sorted(classifier.labels()))
+    label_probdist = classifier._label_probdist
+    feature_probdist = classifier._feature_probdist
+
+    fnames = sorted(set(fname for label, fname in feature_probdist))
+    vocabulary = {fname: idx for idx, fname in enumerate(fnames)}
+
+    log_priors = numpy.array([label_probdist.prob(label) for label in labels], dtype=numpy.float64)
+    log_priors = numpy.log(log_priors)
+
+    log_likelihoods = numpy.full((len(vocabulary), len(labels)), -numpy.inf, dtype=numpy.float64)
+
+    for (label, fname), probdist in feature_probdist.items():
+        log_likelihoods[vocabulary[fname], labels.index(label)] = numpy.log(probdist.prob(True))
+
+    return Model(
+        labels=labels,
+        vocabulary=vocabulary,
+        log_priors=log_priors,
+        log_likelihoods=log_likelihoods,
+    )
+
+
+def get_feature_matrix(model, word_lists):
+    # Sparse (documents x vocabulary) presence matrix in coordinate form.
+    # Every word counts once per document, just like the nltk word maps.
+    rows = []
+    columns = []
+    count = 0
+
+    for row, words in enumerate(word_lists):
+        ids = set(model.vocabulary[word] for word in words if word in model.vocabulary)
+        rows.extend([row] * len(ids))
+        columns.extend(ids)
+        count += 1
+
+    return numpy.array(rows, dtype=numpy.intp), numpy.array(columns, dtype=numpy.intp), count
+
+
+def get_log_scores(model, word_lists):
+    rows, columns, count = get_feature_matrix(model, word_lists)
+    scores = numpy.tile(numpy.asarray(model.log_priors, dtype=numpy.float64), (count, 1))
+
+    if not count or not len(columns):
+        return scores
+
+    # Sparse matrix x dense matrix product, one label column at a time.
+    feature_scores = model.log_likelihoods[columns]
+
+    for label_idx in range(len(model.labels)):
+        scores[:, label_idx] += numpy.bincount(
+            rows,
+            weights=feature_scores[:, label_idx],
+            minlength=count,
+        )
+
+    return scores
+
+
+def get_probabilities(model, word_lists):
+    scores = get_log_scores(model, word_lists)
+
+    if not len(scores):
+        return scores
+
+    scores -= scores.max(axis=1, keepdims=True)
+    probabilities = numpy.exp(scores)
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+    return probabilities
+
+
+def load_counts(filename):
+    with open(filename, "rb") as fh:
+        content = pickle.load(fh)
+
+    if content["version"] != COUNTS_VERSION:
+        raise ValueError("Unsupported counts version {} in {}".format(content["version"], filename))
+
+    counts = get_empty_counts()
+    counts.word_counts.update(content["word_counts"])
+
+    for label, label_word_sets in content["word_sets"].items():
+        counts.word_sets[label].update(label_word_sets)
+
+    return counts
+
+
+def load_model(filename):
+    with open(filename, "rb") as fh:
+        header = fh.read(MODEL_HEADER.size)
+        magic, version, label_count, word_count, text_size = MODEL_HEADER.unpack(header)
+
+        if magic != MODEL_MAGIC:
+            raise ValueError("{} is not a naive Bayes model file".format(filename))
+
+        if version != MODEL_VERSION:
+            raise ValueError("Unsupported model version {} in {}".format(version, filename))
+
+        text = fh.read(text_size).decode("utf-8")
+
+    names = text.split("\n")
+    labels = tuple(names[:label_count])
+    vocabulary = dict(zip(names[label_count:], range(word_count)))
+
+    # The probabilities are mapped straight from the file, pages are only
+    # read on first access and shared between processes by the OS.
+    offset = get_aligned_offset(MODEL_HEADER.size + text_size)
+    values = numpy.memmap(
+        filename,
+        dtype=MODEL_DTYPE,
+        mode="r",
+        offset=offset,
+        shape=(label_count + word_count * label_count,),
+    )
+
+    return Model(
+        labels=labels,
+        vocabulary=vocabulary,
+        log_priors=values[:label_count],
+        log_likelihoods=values[label_count:].reshape((word_count, label_count)),
+    )
+
+
+def get_aligned_offset(offset):
+    return -(-offset // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+
+
+def merge_counts(counts, other):
+    counts.word_counts.update(other.word_counts)
+
+    for label, label_word_sets in other.word_sets.items():
+        counts.word_sets[label].update(label_word_sets)
+
+    return counts
+
+
+@contextlib.contextmanager
+def open_replacing(filename):
+    # Writes a new file and swaps it in, processes that have the old model
+    # memory-mapped keep reading it. Truncating a mapped file in place would
+    # kill them with SIGBUS. The temporary name is per process, so Spark
+    # workers saving to the same path don't write into each other's file.
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+
+    try:
+        with open(tmp_filename, "wb") as fh:
+            yield fh
+
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+        raise
+
+
+def save_counts(counts, filename):
+    # Plain dicts only, so the file can be read no matter whether this
+    # module was imported as part of the classifiers package or not.
+    content = {
+        "version": COUNTS_VERSION,
+        "word_counts": dict(counts.word_counts),
+        "word_sets": {label: dict(value) for label, value in counts.word_sets.items()},
+    }
+
+    with open_replacing(filename) as fh:
+        pickle.dump(content, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def save_model(model, filename):
+    words = sorted(model.vocabulary, key=model.vocabulary.get)
+    text = "\n".join(model.labels + tuple(words)).encode("utf-8")
+
+    header = MODEL_HEADER.pack(MODEL_MAGIC, MODEL_VERSION, len(model.labels), len(words), len(text))
+    offset = MODEL_HEADER.size + len(text)
+
+    log_likelihoods = numpy.asarray(model.log_likelihoods)[[model.vocabulary[word] for word in words]]
+
+    with open_replacing(filename) as fh:
+        fh.write(header)
+        fh.write(text)
+        fh.write(b"\0" * (get_aligned_offset(offset) - offset))
+        fh.write(numpy.asarray(model.log_priors, dtype=MODEL_DTYPE).tobytes())
+        fh.write(numpy.ascontiguousarray(log_likelihoods, dtype=MODEL_DTYPE).tobytes())
+
+
+def update_counts(counts, label, words):
+    if not words:
+        return False
+
+    counts.word_counts.update(words)
+    counts.word_sets[label][frozenset(words)] += 1
+
+    return True
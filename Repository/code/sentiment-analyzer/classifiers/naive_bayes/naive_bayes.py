@@ -2,31 +2,57 @@
 
 import argparse
 import collections
+import functools
 import itertools
 import logging
 import lzma
+import multiprocessing
 import os
 import pickle
 import random
-import re
+import sys
+import time
 
 import nltk
 
+try:
+    from . import engine
+    from .. import batching
+except ImportError:
+    # Run as a script from its own directory.
+    sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+    import batching
+    import engine
+
 try:
     import pyspark
 except ImportError:
     pyspark = None
 
 BASEDIR = os.path.dirname(__file__)
+BENCHMARK_CORPUS_FRACTIONS = (0.125, 0.25, 0.5, 1)
+CLASSIFY_BATCH_SIZE = 1000
 CORPUS_BASEDIR = os.path.join(BASEDIR, "corpus")
+COUNTS_FILENAME = "naive_bayes.counts.pickle"
+CORPUS_SHARD_SIZE = 8 * 1024 * 1024
 INFORMATIVE_FEATURES = 15
+MODEL_FILENAME = "naive_bayes.model"
 #PICKLE_FILENAME = os.path.join(BASEDIR, "naive_bayes.pickle.xz")
 STOP_WORDS_FILENAME = "stop_words.txt"
 TEST_SIZE = 1000
-WHITESPACE_PATTERN = re.compile(r"\s{2,}")
-WORD_PATTERN = re.compile(r"[^a-z ]")
+TOKEN_CACHE_SIZE = 100000
+VERIFY_TOLERANCE = 1e-4  # Saved models store float32 log-probabilities.
+WORD_CHARACTERS = b"abcdefghijklmnopqrstuvwxyz "
 WORD_SAMPLE_SIZE = 10000
 
+NON_WORD_BYTES = bytes(char for char in range(256) if char not in WORD_CHARACTERS)
+
+CORPUS_FILENAMES = {
+    "neg": "negative.txt",
+    "neutral": "neutral.txt",
+    "pos": "positive.txt",
+}
+
 TEST_SENTENCES = (
     "I'm feeling so good today!",
     "I'm feeling so bad today!",
@@ -52,6 +78,7 @@ TEST_SENTENCES = (
 )
 
 cached_classifier = None
+cached_model = None
 
 
 def check_for_empty_sentences(training_set):
@@ -62,18 +89,35 @@ def check_for_empty_sentences(training_set):
 
 
 def classify(text):
-    words = get_word_list(text)
+    model = get_model()
+    probabilities = engine.get_probabilities(model, (get_cached_word_list(text),))
     
-    word_map = {}
-    
-    for word in words:
-        word_map[word] = True
-    
-    classifier = get_classifier()
-    probability_distribution = classifier.prob_classify(word_map)
+    return get_classification(model, probabilities[0])
+
+
+def classify_many(texts, batch_size=CLASSIFY_BATCH_SIZE):
+    model = get_model()
     
-    sample = probability_distribution.max()
-    probability = probability_distribution.prob(sample)
+    for batch in batching.get_batches(texts, batch_size):
+        word_lists = map(get_cached_word_list, batch)
+        probabilities = engine.get_probabilities(model, word_lists)
+        
+        cache_info = get_cached_word_list.cache_info()
+        logger.debug("Token cache: {} hits, {} misses, {}/{} entries".format(
+            cache_info.hits,
+            cache_info.misses,
+            cache_info.currsize,
+            cache_info.maxsize,
+        ))
+        
+        for row in probabilities:
+            yield get_classification(model, row)
+
+
+def get_classification(model, probabilities):
+    sample_idx = int(probabilities.argmax())
+    sample = model.labels[sample_idx]
+    probability = float(probabilities[sample_idx])
     
     polarity = map_number_range(probability, 0.5, 1, 0, 1)
     
@@ -87,17 +131,11 @@ def classify(text):
     }
 
 
-def get_all_words():
+def get_all_words(labeled_sentences):
     stop_words = get_stop_words()
     all_words = collections.Counter()
     
-    sentences = itertools.chain(
-        get_positive_sentences(),
-        get_negative_sentences(),
-        get_neutral_sentences(),
-    )
-    
-    for sentence in sentences:
+    for sentiment, sentence in labeled_sentences:
         words = get_word_list(sentence)
         words = filter(lambda word: word not in stop_words, words)
         all_words.update(words)
@@ -135,12 +173,139 @@ def get_classifier():
     return classifier
 
 
+def get_counts():
+    filename = os.path.join(BASEDIR, COUNTS_FILENAME)
+
+    if pyspark:
+        filename = pyspark.SparkFiles.get(os.path.basename(filename))
+
+    if os.path.exists(filename):
+        logger.debug("Using saved word counts ...")
+        return engine.load_counts(filename)
+    
+    logger.info("Counting words of corpus ...")
+    counts = get_new_counts()
+    
+    logger.info("Caching word counts ...")
+    save_counts(counts)
+    
+    return counts
+
+
+def get_new_counts(processes=1):
+    start = time.perf_counter()
+    
+    if processes == 1:
+        counts = engine.get_empty_counts()
+        sentence_count = partial_fit(counts, get_labeled_sentences())
+    else:
+        counts, sentence_count = get_parallel_counts(processes)
+    
+    duration = time.perf_counter() - start
+    
+    logger.info("Counted {} sentences with {} different words in {:.2f} s ({:.0f} sentences/s)".format(
+        sentence_count,
+        len(counts.word_counts),
+        duration,
+        sentence_count / duration,
+    ))
+    
+    return counts
+
+
+def get_parallel_counts(processes):
+    shards = []
+    
+    # Same order as get_labeled_sentences(), so words with equal counts are
+    # picked for the vocabulary in the same order as when counting serially.
+    for sentiment in ("pos", "neg", "neutral"):
+        shards.extend(get_corpus_shards(sentiment, CORPUS_SHARD_SIZE))
+    
+    logger.info("Counting {} corpus shards with {} processes ...".format(len(shards), processes or os.cpu_count()))
+    
+    counts = engine.get_empty_counts()
+    sentence_count = 0
+    
+    with multiprocessing.Pool(processes) as pool:
+        for shard_counts, shard_sentence_count in pool.imap(count_corpus_shard, shards):
+            engine.merge_counts(counts, shard_counts)
+            sentence_count += shard_sentence_count
+    
+    return counts, sentence_count
+
+
+def get_corpus_filename(sentiment):
+    filename = os.path.join(CORPUS_BASEDIR, CORPUS_FILENAMES[sentiment])
+
+    if pyspark:
+        filename = pyspark.SparkFiles.get(os.path.basename(filename))
+    
+    return filename
+
+
+def get_corpus_shards(sentiment, shard_size):
+    filename = get_corpus_filename(sentiment)
+    size = os.path.getsize(filename)
+    
+    for start in range(0, size, shard_size):
+        yield sentiment, filename, start, min(start + shard_size, size)
+
+
+def count_corpus_shard(shard):
+    # Runs in a worker process. A shard owns every line that starts inside
+    # its byte range, so shards can be cut without looking at the content.
+    sentiment, filename, start, end = shard
+    
+    def get_shard_sentences():
+        with open(filename, "rb") as fh:
+            if start:
+                fh.seek(start - 1)
+                fh.readline()
+            
+            while fh.tell() < end:
+                line = fh.readline()
+                
+                if not line:
+                    return
+                
+                yield sentiment, line.decode("utf-8", errors="ignore")
+    
+    counts = engine.get_empty_counts()
+    sentence_count = partial_fit(counts, get_shard_sentences())
+    
+    return counts, sentence_count
+
+
+def get_model():
+    global cached_model
+    
+    if cached_model:
+        return cached_model
+    
+    filename = os.path.join(BASEDIR, MODEL_FILENAME)
+
+    if pyspark:
+        filename = pyspark.SparkFiles.get(os.path.basename(filename))
+
+    if os.path.exists(filename):
+        logger.debug("Using saved model ...")
+        cached_model = engine.load_model(filename)
+        return cached_model
+    
+    logger.info("Creating model from word counts ...")
+    model = engine.get_model_from_counts(get_counts(), WORD_SAMPLE_SIZE)
+    save_model(model)
+    
+    cached_model = engine.load_model(filename)
+    return cached_model
+
+
 def get_new_classifier(print_accuracy=False):
     logger.info("Loading all words ...")
-    all_words = get_all_words()
-    logger.info("Using {} words".format(len(all_words)))
+    vocabulary = get_vocabulary(get_all_words(get_labeled_sentences()))
+    logger.info("Using {} words".format(len(vocabulary)))
     
-    training_set = get_labeled_training_set(all_words)
+    training_set = get_labeled_training_set(vocabulary, get_labeled_sentences())
     
     if print_accuracy:
         logger.info("Loading training set into memory ...")
@@ -163,7 +328,7 @@ def get_new_classifier(print_accuracy=False):
     classifier.show_most_informative_features(INFORMATIVE_FEATURES)
     
     for sentence in TEST_SENTENCES:
-        word_map = get_word_map(all_words, sentence)
+        word_map = get_word_map(vocabulary, sentence)
         logger.info(sentence)
         
         prob = classifier.prob_classify(word_map)
@@ -205,7 +370,7 @@ def get_neutral_sentences():
     return get_sentences(filename)
 
 
-def get_labeled_training_set(all_words):
+def get_labeled_sentences():
     training_sets = (
         ("pos", get_positive_sentences()),
         ("neg", get_negative_sentences()),
@@ -213,13 +378,20 @@ def get_labeled_training_set(all_words):
     )
     
     for sentiment, sentences in training_sets:
-        for word_map in get_word_maps(all_words, sentences):
-            # Do not add sentences that only consist of stop words or exotic words.
-            # They add no value to the training set.
-            if True not in word_map.values():
-                continue
-            
-            yield word_map, sentiment
+        for sentence in sentences:
+            yield sentiment, sentence
+
+
+def get_labeled_training_set(vocabulary, labeled_sentences):
+    for sentiment, sentence in labeled_sentences:
+        word_map = get_word_map(vocabulary, sentence)
+        
+        # Do not add sentences that only consist of stop words or exotic words.
+        # They add no value to the training set.
+        if not word_map:
+            continue
+        
+        yield word_map, sentiment
 
 
 def get_logger():
@@ -256,7 +428,7 @@ def get_sentences(filename):
 
 
 def get_stop_words():
-    stop_words = []
+    stop_words = set()
     
     filename = os.path.join(BASEDIR, STOP_WORDS_FILENAME)
 
@@ -265,44 +437,56 @@ def get_stop_words():
 
     with open(filename) as fh:
         for line in fh:
-            line = line.strip()
-            line = line.lower()
-            line = WORD_PATTERN.sub("", line)
+            line = " ".join(get_word_list(line))
             
             if not line:
                 continue
             
-            stop_words.append(line)
+            stop_words.add(line)
     
-    return stop_words
+    return frozenset(stop_words)
 
 
 def get_word_list(sentence):
+    # Keeps only a-z and spaces in one pass: the ASCII encoder drops every
+    # other character outside of ASCII, translate() the rest.
     sentence = sentence.lower()
-    sentence = WORD_PATTERN.sub("", sentence)
-    sentence = WHITESPACE_PATTERN.sub(" ", sentence)
-    sentence = sentence.strip()
+    sentence = sentence.encode("ascii", errors="ignore")
+    sentence = sentence.translate(None, NON_WORD_BYTES)
     
-    words = sentence.split(" ")
-    return words
+    words = tuple(sentence.decode("ascii").split())
+    return words or ("",)
+
+
+# Retweets and spam bots post the same message over and over again.
+get_cached_word_list = functools.lru_cache(maxsize=TOKEN_CACHE_SIZE)(get_word_list)
 
 
-def get_word_map(all_words, sentence):
-    word_map = {}
+def get_vocabulary(all_words):
+    return {word: idx for idx, word in enumerate(all_words)}
+
+
+def get_word_map(vocabulary, sentence):
+    # Only words of the vocabulary are mapped, absent words are left out
+    # since that is much more memory efficient than mapping them to False.
     words = get_word_list(sentence)
-    
-    for word in all_words:
-        #word_map[word] = word in words
-        # Much more memory efficient:
-        if word in words:
-            word_map[word] = True
-    
-    return word_map
+    return {word: True for word in words if word in vocabulary}
 
 
-def get_word_maps(all_words, sentences):
-    for sentence in sentences:
-        yield get_word_map(all_words, sentence)
+def partial_fit(counts, labeled_sentences):
+    stop_words = get_stop_words()
+    sentence_count = 0
+    
+    for sentiment, sentence in labeled_sentences:
+        # Keeps the empty word of sentences without any words, nltk gets
+        # it as a feature as well (see get_all_words).
+        words = [word for word in get_word_list(sentence) if word not in stop_words]
+        
+        # Sentences that only consist of stop words add no value.
+        if engine.update_counts(counts, sentiment, words):
+            sentence_count += 1
+    
+    return sentence_count
 
 
 def map_number_range(number, input_start, input_end, output_start, output_end):
@@ -323,10 +507,168 @@ def save_classifier(classifier):
         pickle.dump(classifier, fh)
 
 
+def benchmark_training():
+    logger.info("Loading corpus into memory ...")
+    labeled_sentences = list(get_labeled_sentences())
+    random.shuffle(labeled_sentences)
+    
+    for fraction in BENCHMARK_CORPUS_FRACTIONS:
+        sample = labeled_sentences[:int(len(labeled_sentences) * fraction)]
+        start = time.perf_counter()
+        
+        vocabulary = get_vocabulary(get_all_words(sample))
+        training_set = get_labeled_training_set(vocabulary, sample)
+        nltk.NaiveBayesClassifier.train(training_set)
+        
+        duration = time.perf_counter() - start
+        
+        logger.info("Trained on {} sentences in {:.2f} s ({:.0f} sentences/s)".format(
+            len(sample),
+            duration,
+            len(sample) / duration,
+        ))
+
+
+def get_max_posterior_error(classifier, model, sentences):
+    word_lists = tuple(map(get_word_list, sentences))
+    probabilities = engine.get_probabilities(model, word_lists)
+    max_error = 0
+    
+    for words, row in zip(word_lists, probabilities):
+        word_map = {word: True for word in words}
+        probability_distribution = classifier.prob_classify(word_map)
+        
+        for label_idx, label in enumerate(model.labels):
+            error = abs(probability_distribution.prob(label) - row[label_idx])
+            max_error = max(max_error, error)
+    
+    return max_error
+
+
+def train_nltk_classifier(labeled_sentences):
+    # The training get_new_classifier() does, without the reporting.
+    labeled_sentences = tuple(labeled_sentences)
+    vocabulary = get_vocabulary(get_all_words(labeled_sentences))
+    
+    return nltk.NaiveBayesClassifier.train(get_labeled_training_set(vocabulary, labeled_sentences))
+
+
+def verify_model():
+    sentences = itertools.chain(
+        TEST_SENTENCES,
+        get_positive_sentences(),
+        get_negative_sentences(),
+        get_neutral_sentences(),
+    )
+    sentences = tuple(sentences)
+    
+    classifier = get_classifier()
+    verify_posteriors("converted", classifier, engine.get_model_from_nltk_classifier(classifier), sentences)
+    
+    # The cached classifier may be older than the corpus, so the counts are
+    # compared with a classifier trained on the same sentences.
+    logger.info("Training nltk classifier and counting words of the corpus ...")
+    classifier = train_nltk_classifier(get_labeled_sentences())
+    counts = engine.get_empty_counts()
+    partial_fit(counts, get_labeled_sentences())
+    verify_posteriors("counted", classifier, engine.get_model_from_counts(counts, WORD_SAMPLE_SIZE), sentences)
+
+
+def verify_posteriors(name, classifier, model, sentences):
+    logger.info("Comparing posteriors of the {} model for {} sentences with nltk ...".format(name, len(sentences)))
+    max_error = get_max_posterior_error(classifier, model, sentences)
+    logger.info("Maximum posterior difference: {:.3g}".format(max_error))
+    
+    if max_error > VERIFY_TOLERANCE:
+        raise ValueError("Posteriors of the {} model differ from nltk by {:.3g} (tolerance {:.3g})".format(
+            name,
+            max_error,
+            VERIFY_TOLERANCE,
+        ))
+
+
+def set_model(model):
+    global cached_model
+    
+    cached_model = model
+
+
+def save_counts(counts):
+    filename = os.path.join(BASEDIR, COUNTS_FILENAME)
+
+    if pyspark:
+        filename = pyspark.SparkFiles.get(os.path.basename(filename))
+    
+    engine.save_counts(counts, filename)
+
+
+def update_model(sentiment, filename):
+    start = time.perf_counter()
+    
+    sentences = tuple(get_sentences(filename))
+    counts = get_counts()
+    
+    logger.info("Adding {} {} sentences ...".format(len(sentences), sentiment))
+    labeled_sentences = ((sentiment, sentence) for sentence in sentences)
+    sentence_count = partial_fit(counts, labeled_sentences)
+    
+    logger.info("Appending sentences to {} corpus ...".format(sentiment))
+    
+    with open(get_corpus_filename(sentiment), "a") as fh:
+        for sentence in sentences:
+            fh.write(sentence if sentence.endswith("\n") else sentence + "\n")
+    
+    save_counts(counts)
+    save_model(engine.get_model_from_counts(counts, WORD_SAMPLE_SIZE))
+    
+    logger.info("Added {} sentences in {:.2f} s".format(sentence_count, time.perf_counter() - start))
+
+
+def save_model(model):
+    filename = os.path.join(BASEDIR, MODEL_FILENAME)
+
+    if pyspark:
+        filename = pyspark.SparkFiles.get(os.path.basename(filename))
+    
+    engine.save_model(model, filename)
+
+
+def convert_classifier():
+    filename = os.path.join(BASEDIR, MODEL_FILENAME)
+    
+    start = time.perf_counter()
+    classifier = get_saved_classifier()
+    pickle_duration = time.perf_counter() - start
+    
+    logger.info("Converting classifier to model ...")
+    save_model(engine.get_model_from_nltk_classifier(classifier))
+    
+    start = time.perf_counter()
+    model = engine.load_model(filename)
+    engine.get_probabilities(model, (TEST_SENTENCES[0].split(" "),))
+    model_duration = time.perf_counter() - start
+    
+    logger.info("Saved {} words to {} ({} bytes)".format(
+        len(model.vocabulary),
+        filename,
+        os.path.getsize(filename),
+    ))
+    logger.info("Load time pickle: {:.3f} s, model: {:.3f} s ({:.0f}x faster)".format(
+        pickle_duration,
+        model_duration,
+        pickle_duration / model_duration,
+    ))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-a", "--accuracy", action="store_true", help="only print accuracy, don't create cached classifier")
+    parser.add_argument("-b", "--benchmark", action="store_true", help="measure training time for growing corpus sizes")
+    parser.add_argument("-c", "--convert", action="store_true", help="convert the cached classifier to the model format")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="count the corpus with this many processes, 0 for one per CPU")
+    parser.add_argument("-u", "--update", nargs=2, metavar=("SENTIMENT", "FILE"), help="add the sentences of a file to the corpus and model")
     parser.add_argument("-t", "--test", help="classify a test string")
+    parser.add_argument("-v", "--verify", action="store_true", help="compare the vectorized posteriors with nltk")
     
     args = parser.parse_args()
     
@@ -334,11 +676,36 @@ def main():
         print(classify(args.test))
         return
     
-    classifier = get_new_classifier(args.accuracy)
+    if args.verify:
+        verify_model()
+        return
+    
+    if args.benchmark:
+        benchmark_training()
+        return
+    
+    if args.convert:
+        convert_classifier()
+        return
+    
+    if args.update:
+        sentiment, filename = args.update
+        
+        if sentiment not in CORPUS_FILENAMES:
+            parser.error("sentiment must be one of {}".format(", ".join(sorted(CORPUS_FILENAMES))))
+        
+        update_model(sentiment, filename)
+        return
+    
+    if args.accuracy:
+        get_new_classifier(args.accuracy)
+        return
+    
+    counts = get_new_counts(args.processes or None)
     
-    if not args.accuracy:
-        logger.info("Caching classifier ...")
-        save_classifier(classifier)
+    logger.info("Caching word counts and model ...")
+    save_counts(counts)
+    save_model(engine.get_model_from_counts(counts, WORD_SAMPLE_SIZE))
     
 
 logger = get_logger()
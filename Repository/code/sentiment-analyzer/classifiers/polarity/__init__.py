@@ -1 +1 @@
-from .polarity import classify
+from .polarity import classify, classify_many
@@ -1,5 +1,10 @@
 import textblob
 
+from .. import batching
+
+
+CLASSIFY_BATCH_SIZE = 1000
+
 
 def classify(text):
     analysis_result = textblob.TextBlob(text)
@@ -8,3 +13,10 @@ def classify(text):
         "polarity": analysis_result.sentiment.polarity,
         "subjectivity": analysis_result.sentiment.subjectivity,
     }
+
+
+def classify_many(texts, batch_size=CLASSIFY_BATCH_SIZE):
+    # TextBlob has no batch API, batches only bound how much input is read ahead.
+    for batch in batching.get_batches(texts, batch_size):
+        for text in batch:
+            yield classify(text)
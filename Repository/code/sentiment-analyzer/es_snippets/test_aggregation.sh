@@ -6,15 +6,9 @@ curl -XGET 'localhost:9200/twitter/tweet/_search?pretty' -d '{
                 "interval" : "10000s"
             },
             "aggs": {
-                "by_sentiment" : {
+                "by_sentiment_naive_bayes" : {
                     "terms" : {
-                        "script" : {
-                            "lang": "groovy",
-                            "file": "polarity_to_class",
-                            "params": {
-                                "classifier": "naive_bayes"
-                            }
-                        }
+                        "field": "sentiment_class_naive_bayes"
                     }
                 }
             }
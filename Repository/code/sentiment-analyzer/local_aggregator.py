@@ -0,0 +1,387 @@
+import collections
+import csv
+import itertools
+import logging
+import re
+
+import numpy
+
+import scroll_reader
+
+
+CHUNK_SIZE = 100000
+CONTEXT_TIMEOUT = "1m"
+INTERVAL_PATTERN = re.compile(r"^(\d+)(ms|s|m|h|d|w)$")
+INTERVAL_UNIT_MILLIS = {
+    "ms": 1,
+    "s": 1000,
+    "m": 60 * 1000,
+    "h": 60 * 60 * 1000,
+    "d": 24 * 60 * 60 * 1000,
+    "w": 7 * 24 * 60 * 60 * 1000,
+}
+SCROLL_BATCH_SIZE = 5000
+SCROLL_PREFETCH_PAGES = 4
+TERMS_SIZE = 10
+
+# The subset of the query DSL the aggregator and the price predictor send:
+# range queries on the histogram field, exact matches on other fields and
+# one date_histogram with avg and terms sub aggregations.
+Histogram = collections.namedtuple("Histogram", ("name", "field", "interval", "avgs", "terms", "range", "matches"))
+HistogramBucket = collections.namedtuple("HistogramBucket", ("doc_count", "avgs", "terms"))
+
+
+def get_bucket_response(histogram, key, bucket):
+    response = {
+        "key_as_string": get_formatted_key(key),
+        "key": key,
+        "doc_count": bucket.doc_count if bucket else 0,
+    }
+
+    for name, field in histogram.avgs:
+        value_sum, value_count = bucket.avgs[name] if bucket else (0.0, 0)
+
+        response[name] = {
+            "value": value_sum / value_count if value_count else None,
+        }
+
+    for name, field, size in histogram.terms:
+        counts = bucket.terms[name] if bucket else collections.Counter()
+
+        # Same order as Elasticsearch: most documents first, then by term.
+        term_counts = sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+
+        response[name] = {
+            "doc_count_error_upper_bound": 0,
+            "sum_other_doc_count": sum(count for term, count in term_counts[size:]),
+            "buckets": [{"key": term, "doc_count": count} for term, count in term_counts[:size]],
+        }
+
+    return response
+
+
+def get_csv_rows(filename):
+    # es-dumper CSV files, empty cells are treated as missing fields.
+    with open(filename, newline="") as fh:
+        for row in csv.DictReader(fh):
+            yield row
+
+
+def get_epoch_millis(values):
+    # Same input formats as strict_date_optional_time||epoch_millis for the
+    # values the scrapers store. Missing dates are masked out.
+    millis = numpy.zeros(len(values), dtype=numpy.int64)
+    present = numpy.ones(len(values), dtype=bool)
+    strings = []
+    string_indexes = []
+
+    for idx, value in enumerate(values):
+        if value is None or value == "":
+            present[idx] = False
+        elif isinstance(value, (int, float)):
+            millis[idx] = int(value)
+        elif value.isdigit() and len(value) > 4:
+            millis[idx] = int(value)
+        else:
+            strings.append(value[:-1] if value.endswith("Z") else value)
+            string_indexes.append(idx)
+
+    if strings:
+        # Parsing to millisecond precision drops the microseconds the
+        # scrapers store, just like Elasticsearch does.
+        parsed = numpy.array(strings, dtype="datetime64[ms]")
+        millis[string_indexes] = parsed.astype(numpy.int64)
+
+    return millis, present
+
+
+def get_fields(histogram):
+    fields = [histogram.field]
+    fields.extend(field for name, field in histogram.avgs)
+    fields.extend(field for name, field, size in histogram.terms)
+    fields.extend(field for field, value in histogram.matches)
+
+    return sorted(set(fields))
+
+
+def get_formatted_key(key):
+    return "{}Z".format(numpy.datetime_as_string(numpy.datetime64(key, "ms"), unit="ms"))
+
+
+def get_histogram(body):
+    aggs = body.get("aggs", {})
+
+    if len(aggs) != 1:
+        raise ValueError("Expected exactly one date_histogram aggregation, got {}".format(sorted(aggs)))
+
+    name, agg = next(iter(aggs.items()))
+
+    if "date_histogram" not in agg:
+        raise ValueError("Unsupported aggregation {}".format(name))
+
+    avgs = []
+    terms = []
+
+    for sub_name, sub_agg in agg.get("aggs", {}).items():
+        if "avg" in sub_agg:
+            avgs.append((sub_name, sub_agg["avg"]["field"]))
+        elif "terms" in sub_agg and "field" in sub_agg["terms"]:
+            terms.append((sub_name, sub_agg["terms"]["field"], sub_agg["terms"].get("size", TERMS_SIZE)))
+        else:
+            raise ValueError("Unsupported sub aggregation {}".format(sub_name))
+
+    field = agg["date_histogram"]["field"]
+    bounds = {}
+    matches = []
+    update_query_filters(body.get("query"), field, bounds, matches)
+
+    return Histogram(
+        name=name,
+        field=field,
+        interval=get_interval_millis(agg["date_histogram"]["interval"]),
+        avgs=tuple(avgs),
+        terms=tuple(terms),
+        range=bounds,
+        matches=tuple(matches),
+    )
+
+
+def get_interval_millis(interval):
+    # Only fixed length intervals, calendar intervals like "month" depend on
+    # the date and are not supported.
+    match = INTERVAL_PATTERN.match(str(interval))
+
+    if not match:
+        raise ValueError("Unsupported date_histogram interval {}".format(interval))
+
+    return int(match.group(1)) * INTERVAL_UNIT_MILLIS[match.group(2)]
+
+
+def get_logger():
+    logger = logging.getLogger("psais.localaggregator")
+    logger.setLevel(logging.DEBUG)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def get_range_mask(millis, bounds):
+    mask = numpy.ones(len(millis), dtype=bool)
+
+    if "gt" in bounds:
+        mask &= millis > bounds["gt"]
+
+    if "gte" in bounds:
+        mask &= millis >= bounds["gte"]
+
+    if "lt" in bounds:
+        mask &= millis < bounds["lt"]
+
+    if "lte" in bounds:
+        mask &= millis <= bounds["lte"]
+
+    return mask
+
+
+def get_scroll_rows(db, index, doc_type, body):
+    """Yields the _source of every document the search body aggregates.
+
+    Only the fields used by the aggregations are fetched.
+    """
+    histogram = get_histogram(body)
+
+    response = db.search(
+        index=index,
+        doc_type=doc_type,
+        scroll=CONTEXT_TIMEOUT,
+        search_type="scan",
+        body={
+            "query": body.get("query", {"match_all": {}}),
+            "_source": get_fields(histogram),
+            "size": SCROLL_BATCH_SIZE,
+        },
+    )
+
+    logger.info("Streaming {} documents ...".format(response["hits"]["total"]))
+
+    if not response["hits"]["total"]:
+        return
+
+    for response in scroll_reader.get_scroll_pages(db, response, CONTEXT_TIMEOUT, SCROLL_PREFETCH_PAGES):
+        for hit in response["hits"]["hits"]:
+            yield hit["_source"]
+
+
+def get_value_column(values):
+    return numpy.array(
+        [numpy.nan if value is None or value == "" else float(value) for value in values],
+        dtype=numpy.float64,
+    )
+
+
+def search(rows, body, chunk_size=CHUNK_SIZE):
+    """Answers a date_histogram search body from rows instead of an index.
+
+    rows are document sources as dicts, e.g. from get_csv_rows() or
+    get_scroll_rows(). They are bucketed chunk by chunk, so memory grows with
+    the number of buckets, not with the number of rows. The result has the
+    shape of the Elasticsearch response, empty buckets between the first and
+    the last one included, so the existing response parsing can be reused.
+    """
+    histogram = get_histogram(body)
+    buckets = {}
+    total = 0
+    rows = iter(rows)
+
+    while True:
+        chunk = tuple(itertools.islice(rows, chunk_size))
+
+        if not chunk:
+            break
+
+        total += update_buckets(buckets, histogram, chunk)
+
+    logger.debug("Aggregated {} documents into {} buckets".format(total, len(buckets)))
+
+    if buckets:
+        keys = range(min(buckets), max(buckets) + histogram.interval, histogram.interval)
+    else:
+        keys = ()
+
+    return {
+        "hits": {
+            "total": total,
+            "max_score": 0.0,
+            "hits": [],
+        },
+        "aggregations": {
+            histogram.name: {
+                "buckets": [get_bucket_response(histogram, key, buckets.get(key)) for key in keys],
+            },
+        },
+    }
+
+
+def update_buckets(buckets, histogram, chunk):
+    millis, present = get_epoch_millis([row.get(histogram.field) for row in chunk])
+    mask = present & get_range_mask(millis, histogram.range)
+
+    for field, value in histogram.matches:
+        mask &= numpy.array([row.get(field) == value for row in chunk], dtype=bool)
+
+    if not mask.any():
+        return 0
+
+    chunk = [row for row, selected in zip(chunk, mask) if selected]
+    keys = millis[mask] // histogram.interval * histogram.interval
+    chunk_keys, inverse = numpy.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    new_buckets = []
+
+    for key in chunk_keys.tolist():
+        if key not in buckets:
+            buckets[key] = HistogramBucket(
+                doc_count=0,
+                avgs={name: (0.0, 0) for name, field in histogram.avgs},
+                terms={name: collections.Counter() for name, field, size in histogram.terms},
+            )
+
+        new_buckets.append(buckets[key])
+
+    doc_counts = numpy.bincount(inverse, minlength=len(chunk_keys))
+    avgs = {}
+
+    for name, field in histogram.avgs:
+        values = get_value_column([row.get(field) for row in chunk])
+        valid = ~numpy.isnan(values)
+
+        # The previous sum of every bucket goes first, so values are added
+        # one after the other in row order no matter how rows are chunked.
+        previous_sums = [bucket.avgs[name][0] for bucket in new_buckets]
+        sums = numpy.bincount(
+            numpy.concatenate((numpy.arange(len(chunk_keys)), inverse[valid])),
+            weights=numpy.concatenate((previous_sums, values[valid])),
+            minlength=len(chunk_keys),
+        )
+        counts = numpy.bincount(inverse[valid], minlength=len(chunk_keys))
+
+        avgs[name] = (sums.tolist(), counts.tolist())
+
+    for idx, key in enumerate(chunk_keys.tolist()):
+        bucket = new_buckets[idx]
+        bucket_avgs = {
+            name: (sums[idx], bucket.avgs[name][1] + counts[idx])
+            for name, (sums, counts) in avgs.items()
+        }
+        buckets[key] = bucket._replace(doc_count=bucket.doc_count + int(doc_counts[idx]), avgs=bucket_avgs)
+
+    for name, field, size in histogram.terms:
+        terms = [row.get(field) for row in chunk]
+        term_codes = {}
+        codes = numpy.array([term_codes.setdefault(term, len(term_codes)) for term in terms], dtype=numpy.intp)
+        counts = numpy.bincount(inverse * len(term_codes) + codes, minlength=len(chunk_keys) * len(term_codes))
+        counts = counts.reshape((len(chunk_keys), len(term_codes)))
+
+        for term, code in term_codes.items():
+            if term is None or term == "":
+                continue
+
+            for idx in numpy.flatnonzero(counts[:, code]).tolist():
+                buckets[chunk_keys[idx].item()].terms[name][term] += int(counts[idx, code])
+
+    return len(chunk)
+
+
+def update_query_filters(query, field, bounds, matches):
+    if query is None or "match_all" in query:
+        return
+
+    if len(query) != 1:
+        raise ValueError("Unsupported query {}".format(query))
+
+    query_type, clause = next(iter(query.items()))
+
+    if query_type == "bool":
+        if set(clause) - {"filter", "must"}:
+            raise ValueError("Unsupported bool query {}".format(clause))
+
+        for key in ("filter", "must"):
+            sub_queries = clause.get(key, ())
+
+            if isinstance(sub_queries, dict):
+                sub_queries = (sub_queries,)
+
+            for sub_query in sub_queries:
+                update_query_filters(sub_query, field, bounds, matches)
+    elif query_type == "range" and set(clause) == {field}:
+        for operator, value in clause[field].items():
+            if operator == "format":
+                continue
+
+            if operator not in ("gt", "gte", "lt", "lte"):
+                raise ValueError("Unsupported range operator {}".format(operator))
+
+            millis, present = get_epoch_millis([value])
+            bounds[operator] = int(millis[0])
+    elif query_type in ("match_phrase", "term") and len(clause) == 1:
+        # Exact matches only, which is what both queries come down to for
+        # the ticker symbols and classes they are used with.
+        match_field, value = next(iter(clause.items()))
+
+        if isinstance(value, dict):
+            value = value["query"] if query_type == "match_phrase" else value["value"]
+
+        matches.append((match_field, value))
+    else:
+        raise ValueError("Unsupported query {}".format(query))
+
+
+logger = get_logger()
@@ -0,0 +1,89 @@
+import logging
+import queue
+import threading
+
+
+PREFETCH_PAGES = 4
+QUEUE_POLL_SECONDS = 0.5
+
+
+def fetch_scroll_pages(db, scroll_id, context_timeout, pages, stopped):
+    # Runs on the prefetch thread and ends with None, or with the exception
+    # that stopped it, unless the reader went away first.
+    try:
+        while not stopped.is_set():
+            response = db.scroll(scroll_id=scroll_id, scroll=context_timeout)
+            scroll_id = response["_scroll_id"]
+
+            if not response["hits"]["hits"]:
+                break
+
+            if not put_page(pages, response, stopped):
+                return
+    except Exception as e:
+        logger.debug("Scroll prefetching failed: {}".format(e))
+        put_page(pages, e, stopped)
+        return
+
+    put_page(pages, None, stopped)
+
+
+def get_logger():
+    logger = logging.getLogger("psais.scrollreader")
+    logger.setLevel(logging.DEBUG)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    ch.setFormatter(formatter)
+
+    logger.addHandler(ch)
+
+    return logger
+
+
+def get_scroll_pages(db, response, context_timeout, prefetch_pages=PREFETCH_PAGES):
+    """Yields the non-empty scroll pages following the initial search response.
+
+    Up to prefetch_pages pages are fetched on a background thread while the
+    caller is still busy with the current one.
+    """
+    pages = queue.Queue(maxsize=prefetch_pages)
+    stopped = threading.Event()
+
+    thread = threading.Thread(
+        target=fetch_scroll_pages,
+        args=(db, response["_scroll_id"], context_timeout, pages, stopped),
+        name="scroll-prefetch",
+        daemon=True,
+    )
+    thread.start()
+
+    try:
+        while True:
+            page = pages.get()
+
+            if page is None:
+                return
+
+            if isinstance(page, Exception):
+                raise page
+
+            yield page
+    finally:
+        stopped.set()
+
+
+def put_page(pages, page, stopped):
+    while not stopped.is_set():
+        try:
+            pages.put(page, timeout=QUEUE_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+logger = get_logger()
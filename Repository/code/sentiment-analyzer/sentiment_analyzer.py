@@ -1,38 +1,241 @@
+import argparse
 import collections
+import datetime
+import glob
 import logging
+import multiprocessing
 import os
+import random
 import re
+import string
 import time
 
 import elasticsearch
 import elasticsearch.helpers
 import ruamel.yaml as yaml
 
+import bulk_writer
 import classifiers
+import classifiers.batching
+import scroll_reader
 
 
 BASEDIR = os.path.dirname(__file__)
+CLASSIFIED_AT_FIELD = "classified_at"
 CONTEXT_TIMEOUT = "1m"
+DEDUP_CACHE_SIZE = 1000000
 DOCUMENT_TYPE = "tweet"
 INDEX_NAME = "twitter"
 REQUEST_TIMEOUT = 60
 SCROLL_BATCH_SIZE = 1000
+SCROLL_PREFETCH_PAGES = 4
+SPAM_BENCHMARK_CORPUS = os.path.join(BASEDIR, "classifiers", "naive_bayes", "corpus", "*.txt")
+SPAM_BENCHMARK_MESSAGES = 1000
+SPAM_BENCHMARK_SIZES = (20, 200, 2000)
+SPAM_FILTER = None
 SPAM_FILTER_FILENAME = os.path.join(BASEDIR, "spam_filter.txt")
-SPAM_FILTERS = []
+SPAM_FILTER_HITS = collections.Counter()
+SPAM_LEADING_WILDCARD_PATTERN = re.compile(r"^\(\.\*(\.?)\)")
+SPAM_PREFIX_LENGTH = 5
 UPDATE_CHUNK_SIZE = 2500
 URL_PATTERN = re.compile(r"https?://\S+", re.IGNORECASE)
 
+SpamFilter = collections.namedtuple("SpamFilter", ("rules", "patterns", "prefixes", "pattern"))
 TweetDocument = collections.namedtuple("TweetDocument", ("id", "data"))
 
+cached_databases = {}
 
-def get_classified_tweet(classifier, classifier_name, tweet):
-    classification = classifier(tweet.data["message"])
 
-    data = {
-        "sentiment_{}".format(classifier_name): classification["polarity"],
-    }
+def analyze(config):
+    db = get_database(config["database"]["host"])
+    start = time.perf_counter()
+
+    classified_tweets = get_classified_tweet_actions(db, config)
+    count, errors = bulk_writer.bulk(db, classified_tweets, chunk_size=UPDATE_CHUNK_SIZE)
+
+    return count, time.perf_counter() - start
+
+
+def analyze_slice(config):
+    # Runs in a worker process with its own database connection.
+    if not SPAM_FILTER:
+        load_spam_filters()
+
+    SPAM_FILTER_HITS.clear()
+    count, duration = analyze(config)
+
+    return count, duration, collections.Counter(SPAM_FILTER_HITS)
+
+
+def analyze_slices(config, workers):
+    db = get_database(config["database"]["host"])
+    slice_filters = get_slice_filters(db, config, workers)
+
+    if not slice_filters:
+        logger.info("No documents to analyze")
+        return
+
+    slice_configs = [dict(config, search_filter=slice_filter) for slice_filter in slice_filters]
+
+    logger.info("Analyzing {} slices with {} worker processes ...".format(len(slice_configs), workers))
+    start = time.perf_counter()
+    total_count = 0
+
+    with multiprocessing.Pool(workers) as pool:
+        for idx, result in enumerate(pool.imap_unordered(analyze_slice, slice_configs), start=1):
+            count, duration, spam_filter_hits = result
+            total_count += count
+            SPAM_FILTER_HITS.update(spam_filter_hits)
+            elapsed = time.perf_counter() - start
+
+            logger.info("{}/{} slices done, slice: {} tweets in {:.1f} s, total: {} tweets ({:.0f} tweets/s)".format(
+                idx,
+                len(slice_configs),
+                count,
+                duration,
+                total_count,
+                total_count / elapsed,
+            ))
+
+
+def backfill_classes(config):
+    db = get_database(config["database"]["host"])
+    start = time.perf_counter()
+
+    field = get_polarity_field(config["classifier"])
+    class_field = get_class_field(config["classifier"])
+    thresholds = config["sentiment_classes"]
+
+    # Only tweets that were classified before the class field existed.
+    backfill_config = dict(config, search_filter={
+        "bool": {
+            "must": {
+                "exists": {
+                    "field": field,
+                },
+            },
+            "must_not": {
+                "exists": {
+                    "field": class_field,
+                },
+            },
+        },
+    })
+
+    actions = (
+        get_save_action(db, TweetDocument(
+            id=tweet.id,
+            data={
+                class_field: get_sentiment_class(tweet.data[field], thresholds),
+                CLASSIFIED_AT_FIELD: get_classified_at(),
+            },
+        ))
+        for tweet in get_tweets(db, backfill_config)
+    )
+
+    count, errors = bulk_writer.bulk(db, actions, chunk_size=UPDATE_CHUNK_SIZE)
+    logger.info("Backfilled {} sentiment classes in {:.1f} s".format(count, time.perf_counter() - start))
+
+
+def benchmark_spam_filters():
+    messages = []
+
+    for filename in glob.glob(SPAM_BENCHMARK_CORPUS):
+        with open(filename, errors="ignore") as fh:
+            messages.extend(line.strip() for line in fh)
+
+    messages = random.sample(messages, min(len(messages), SPAM_BENCHMARK_MESSAGES))
+
+    with open(SPAM_FILTER_FILENAME) as fh:
+        base_rules = [line.strip() for line in fh if line.strip()]
+
+    for size in SPAM_BENCHMARK_SIZES:
+        rules = list(base_rules[:size])
+        size_messages = list(messages)
+
+        while len(rules) < size:
+            word = "".join(random.choice(string.ascii_lowercase) for _ in range(8))
+            rules.append("(.*){} deal of the day(.*.)".format(word))
+            size_messages.append("Only today: {} deal of the day!".format(word.upper()))
+
+        sample = random.sample(size_messages, len(messages))
+
+        patterns = [re.compile(rule, re.IGNORECASE) for rule in rules]
+        spam_filter = get_spam_filter(rules)
+
+        start = time.perf_counter()
+        loop_count = sum(1 for message in sample if any(pattern.search(message) for pattern in patterns))
+        loop_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        combined_count = sum(1 for message in sample if get_spam_rule(spam_filter, message) is not None)
+        combined_duration = time.perf_counter() - start
+
+        if loop_count != combined_count:
+            raise ValueError("Combined filter found {} spam messages, loop found {}".format(combined_count, loop_count))
+
+        logger.info("{} rules, {} messages, {} spam: loop {:.3f} s, combined {:.3f} s ({:.1f}x faster)".format(
+            size,
+            len(messages),
+            combined_count,
+            loop_duration,
+            combined_duration,
+            loop_duration / combined_duration,
+        ))
+
+
+def get_class_field(classifier_name):
+    return "sentiment_class_{}".format(classifier_name)
+
+
+def get_classified_at():
+    # The aggregator finds the buckets to aggregate again by this time, so
+    # tweets classified late for old buckets are picked up as well.
+    return datetime.datetime.utcnow().isoformat()
+
 
-    return TweetDocument(id=tweet.id, data=data)
+def get_classified_tweets(classifier, config, tweets, stats=None):
+    # Retweets, check-ins and promos repeat the same message many times, so
+    # every distinct message is classified once and shared by its tweets.
+    field = get_polarity_field(config["classifier"])
+    class_field = get_class_field(config["classifier"])
+    thresholds = config["sentiment_classes"]
+    polarities = {}
+
+    if stats is None:
+        stats = collections.Counter()
+
+    for batch in classifiers.batching.get_batches(tweets, SCROLL_BATCH_SIZE):
+        messages = dict.fromkeys(tweet.data["message"] for tweet in batch)
+        messages = tuple(message for message in messages if message not in polarities)
+
+        if len(polarities) + len(messages) > DEDUP_CACHE_SIZE:
+            logger.debug("Clearing {} cached classifications".format(len(polarities)))
+            polarities.clear()
+            messages = tuple(dict.fromkeys(tweet.data["message"] for tweet in batch))
+
+        try:
+            classifications = tuple(classifier(messages))
+        except Exception:
+            logger.exception("Error while classifying {} tweets".format(len(batch)))
+            continue
+
+        for message, classification in zip(messages, classifications):
+            polarities[message] = classification["polarity"]
+
+        stats["tweets"] += len(batch)
+        stats["classified"] += len(messages)
+        classified_at = get_classified_at()
+
+        for tweet in batch:
+            polarity = polarities[tweet.data["message"]]
+            data = {
+                field: polarity,
+                class_field: get_sentiment_class(polarity, thresholds),
+                CLASSIFIED_AT_FIELD: classified_at,
+            }
+
+            yield TweetDocument(id=tweet.id, data=data)
 
 
 def get_classified_tweet_actions(db, config):
@@ -41,18 +244,20 @@ def get_classified_tweet_actions(db, config):
     tweets = get_tweets(db, config)
     tweets = filter(lambda x: not is_spam_tweet(x), tweets)
     tweets = map(get_url_filtered_tweet, tweets)
+    stats = collections.Counter()
     
-    for tweet in tweets:
+    for classified_tweet in get_classified_tweets(classifier, config, tweets, stats):
         try:
-            classified_tweet = get_classified_tweet(classifier, config["classifier"], tweet)
             action = get_save_action(db, classified_tweet)
             yield action
         except Exception:
             logger.exception("Error while processing tweet")
 
+    log_dedup_stats(stats)
+
 
 def get_classifier(config):
-    return getattr(classifiers, config["classifier"]).classify
+    return getattr(classifiers, config["classifier"]).classify_many
 
 
 def get_config():
@@ -68,6 +273,13 @@ def get_config():
     return config
 
 
+def get_cached_database(host):
+    if host not in cached_databases:
+        cached_databases[host] = get_database(host)
+
+    return cached_databases[host]
+
+
 def get_database(host):
     logger.debug("Connecting to database ...")
     db = elasticsearch.Elasticsearch(host, timeout=REQUEST_TIMEOUT)
@@ -91,6 +303,10 @@ def get_logger():
     return logger
 
 
+def get_polarity_field(classifier_name):
+    return "sentiment_{}".format(classifier_name)
+
+
 def get_save_action(db, tweet):
     return {
         "_op_type": "update",
@@ -101,6 +317,159 @@ def get_save_action(db, tweet):
     }
 
 
+def get_literal_prefix(rule):
+    # Longest literal text every match of the rule has to start with, or
+    # an empty string if the rule could match anything.
+    depth = 0
+    escaped = False
+
+    for char in rule:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and not depth:
+            return ""
+
+    prefix = []
+
+    for char in rule:
+        if char in ".^$*+?{}[]\\|()":
+            if char in "*?{" and prefix:
+                prefix.pop()
+
+            break
+
+        prefix.append(char)
+
+    return "".join(prefix)
+
+
+def get_sentiment_class(polarity, thresholds):
+    if polarity > thresholds["positive_threshold"]:
+        return "pos"
+
+    if polarity < thresholds["negative_threshold"]:
+        return "neg"
+
+    return "neutral"
+
+
+def get_slice_filters(db, config, count):
+    # Date percentiles give slices with about the same number of tweets
+    # even though tweet volume varies a lot over time.
+    percents = [idx * 100 / count for idx in range(1, count)]
+
+    response = db.search(
+        index=INDEX_NAME,
+        doc_type=DOCUMENT_TYPE,
+        body={
+            "query": config["search_filter"],
+            "size": 0,
+            "aggs": {
+                "date_percentiles": {
+                    "percentiles": {
+                        "field": "date",
+                        "percents": percents,
+                    },
+                },
+            },
+        },
+    )
+
+    if not response["hits"]["total"]:
+        return []
+
+    values = response["aggregations"]["date_percentiles"]["values"]
+    bounds = sorted(set(int(value) for value in values.values() if value is not None))
+    bounds = [None] + bounds + [None]
+
+    slice_filters = []
+
+    for start, end in zip(bounds, bounds[1:]):
+        date_range = {
+            "format": "epoch_millis",
+        }
+
+        if start is not None:
+            date_range["gte"] = start
+
+        if end is not None:
+            date_range["lt"] = end
+
+        slice_filters.append({
+            "bool": {
+                "must": config["search_filter"],
+                "filter": {
+                    "range": {
+                        "date": date_range,
+                    },
+                },
+            },
+        })
+
+    return slice_filters
+
+
+def get_spam_filter(rules):
+    # Leading "(.*)" only costs backtracking with search(), "(.*.)" is the
+    # same as a single ".". Rules are indexed by the first characters of
+    # their literal prefix, so a message only runs the few rules whose
+    # prefix it contains. Rules without such a prefix are combined into one
+    # alternation with a named group per rule.
+    rules = tuple(rules)
+    patterns = []
+    prefixes = collections.defaultdict(list)
+    alternatives = []
+
+    for idx, rule in enumerate(rules):
+        rule = SPAM_LEADING_WILDCARD_PATTERN.sub(lambda x: x.group(1), rule)
+        patterns.append(re.compile(rule, re.IGNORECASE))
+
+        prefix = get_literal_prefix(rule.lstrip("."))
+
+        if len(prefix) >= SPAM_PREFIX_LENGTH:
+            prefixes[prefix[:SPAM_PREFIX_LENGTH].lower()].append(idx)
+        else:
+            alternatives.append("(?P<rule{}>{})".format(idx, rule))
+
+    return SpamFilter(
+        rules=rules,
+        patterns=tuple(patterns),
+        prefixes=dict(prefixes),
+        pattern=re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None,
+    )
+
+
+def get_spam_rule(spam_filter, message):
+    # Most tweets contain none of the rule prefixes and never reach a regex.
+    # The substring lookup costs the same for 20 or 2,000 rules.
+    lowered = message.lower()
+    slices = map(slice, range(len(lowered)), range(SPAM_PREFIX_LENGTH, len(lowered) + SPAM_PREFIX_LENGTH))
+    found_prefixes = spam_filter.prefixes.keys() & set(map(lowered.__getitem__, slices))
+
+    if found_prefixes:
+        candidates = sorted(idx for prefix in found_prefixes for idx in spam_filter.prefixes[prefix])
+
+        for idx in candidates:
+            if spam_filter.patterns[idx].search(message):
+                return spam_filter.rules[idx]
+
+    if not spam_filter.pattern:
+        return None
+
+    match = spam_filter.pattern.search(message)
+
+    if not match:
+        return None
+
+    return spam_filter.rules[int(match.lastgroup[len("rule"):])]
+
+
 def get_tweets(db, config):
     logger.info("Initializing scroll search ...")
 
@@ -115,16 +484,16 @@ def get_tweets(db, config):
         },
     )
 
-    scroll_id = response["_scroll_id"]
     cur_count = response["hits"]["total"]
 
     logger.info("Streaming {} documents ...".format(cur_count))
     processed_count = 0
 
-    while cur_count > 0:
-        response = db.scroll(scroll_id=scroll_id, scroll=CONTEXT_TIMEOUT)
+    if not cur_count:
+        return
+
+    for response in scroll_reader.get_scroll_pages(db, response, CONTEXT_TIMEOUT, SCROLL_PREFETCH_PAGES):
         cur_count = len(response["hits"]["hits"])
-        scroll_id = response["_scroll_id"]
 
         processed_count += cur_count
         progress = processed_count / response["hits"]["total"] * 100
@@ -151,14 +520,23 @@ def get_url_filtered_tweet(tweet):
 
 
 def is_spam_tweet(tweet):
-    for pattern in SPAM_FILTERS:
-        if pattern.search(tweet.data["message"]):
-            return True
-    
-    return False
+    if not SPAM_FILTER:
+        return False
+
+    rule = get_spam_rule(SPAM_FILTER, tweet.data["message"])
+
+    if rule is None:
+        return False
+
+    SPAM_FILTER_HITS[rule] += 1
+    return True
 
 
 def load_spam_filters():
+    global SPAM_FILTER
+
+    rules = []
+
     with open(SPAM_FILTER_FILENAME) as fh:
         for line in fh:
             line = line.strip()
@@ -166,19 +544,83 @@ def load_spam_filters():
             if not line:
                 continue
             
-            pattern = re.compile(line, re.IGNORECASE)
-            SPAM_FILTERS.append(pattern)
+            rules.append(line)
+
+    SPAM_FILTER = get_spam_filter(rules)
+
+
+def log_dedup_stats(stats):
+    if not stats["tweets"]:
+        return
+
+    logger.info("Classified {} distinct messages for {} tweets (dedup ratio {:.1f} %)".format(
+        stats["classified"],
+        stats["tweets"],
+        (1 - stats["classified"] / stats["tweets"]) * 100,
+    ))
+
+
+def log_spam_filter_hits():
+    for rule, count in SPAM_FILTER_HITS.most_common():
+        logger.info("Spam filter hits: {:>6} {}".format(count, rule))
+
+
+def put_class_mapping(db, config):
+    # The aggregator runs a terms aggregation on the class field, so it has
+    # to be indexed as a whole value instead of being analyzed. It also
+    # queries ranges of the classification time.
+    class_field = get_class_field(config["classifier"])
+
+    try:
+        db.indices.put_mapping(
+            index=INDEX_NAME,
+            doc_type=DOCUMENT_TYPE,
+            body={
+                "properties": {
+                    class_field: {
+                        "type": "string",
+                        "index": "not_analyzed",
+                    },
+                    CLASSIFIED_AT_FIELD: {
+                        "type": "date",
+                    },
+                },
+            },
+        )
+    except elasticsearch.exceptions.RequestError:
+        logger.exception("Could not set the mapping of {}".format(class_field))
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill-classes", action="store_true", help="add the sentiment class to tweets classified before it was stored")
+    parser.add_argument("--benchmark-spam-filters", action="store_true", help="compare the combined spam filter with one search per rule")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="analyze date slices of the tweets in this many processes")
+
+    args = parser.parse_args()
+
+    if args.benchmark_spam_filters:
+        benchmark_spam_filters()
+        return
+
     config = get_config()
     logger.setLevel(config["log_level"])
-    db = get_database(config["database"]["host"])
+
+    put_class_mapping(get_database(config["database"]["host"]), config)
+
+    if args.backfill_classes:
+        backfill_classes(config)
+        return
     
     load_spam_filters()
 
-    classified_tweets = get_classified_tweet_actions(db, config)
-    elasticsearch.helpers.bulk(db, classified_tweets, chunk_size=UPDATE_CHUNK_SIZE)
+    if args.workers > 1:
+        analyze_slices(config, args.workers)
+    else:
+        count, duration = analyze(config)
+        logger.info("Analyzed {} tweets in {:.1f} s".format(count, duration))
+
+    log_spam_filter_hits()
 
 
 logger = get_logger()
@@ -1,25 +1,41 @@
+import argparse
 import json
 import os
+import resource
 import tempfile
+import time
 import zipfile
 
+import elasticsearch
+import numpy
 from pyspark import SparkContext, SparkConf
 
-import classifiers
+import bulk_writer
+import classifiers.naive_bayes.engine
+import classifiers.naive_bayes.naive_bayes
 import sentiment_analyzer as sa
 
+COMPARE_INDEX_NAME = sa.INDEX_NAME + "_compare_{}"
 SENTIMENT_ANALYZER_HOME = "/opt/psais/sentiment-analyzer"
 CLASSIFIERS_BASE_DIR = os.path.join(SENTIMENT_ANALYZER_HOME, "classifiers")
 NAIVE_BAYES_BASE_DIR = os.path.join(CLASSIFIERS_BASE_DIR, "naive_bayes")
 NAIVE_BAYES_CORPUS_BASE_DIR = os.path.join(NAIVE_BAYES_BASE_DIR, "corpus")
+NAIVE_BAYES_MODEL_FILENAME = os.path.join(NAIVE_BAYES_BASE_DIR, classifiers.naive_bayes.naive_bayes.MODEL_FILENAME)
 
 
 def add_spark_files(sc):
     classifiers_archive = create_classifier_zipfile()
     
     sc.addPyFile(classifiers_archive)
+    sc.addPyFile(os.path.join(SENTIMENT_ANALYZER_HOME, "bulk_writer.py"))
+    sc.addPyFile(os.path.join(SENTIMENT_ANALYZER_HOME, "scroll_reader.py"))
     sc.addPyFile(os.path.join(SENTIMENT_ANALYZER_HOME, "sentiment_analyzer.py"))
-    sc.addFile(os.path.join(NAIVE_BAYES_BASE_DIR, "naive_bayes.pickle.xz"))
+
+    if not is_trained_on_executors():
+        return
+
+    # Without a saved model every executor has to train its own.
+    sa.logger.info("No saved model, shipping training corpus to the executors ...")
     sc.addFile(os.path.join(NAIVE_BAYES_BASE_DIR, "stop_words.txt"))
     sc.addFile(os.path.join(NAIVE_BAYES_CORPUS_BASE_DIR, "negative.txt"))
     sc.addFile(os.path.join(NAIVE_BAYES_CORPUS_BASE_DIR, "neutral.txt"))
@@ -34,6 +50,10 @@ def create_classifier_zipfile():
     with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as fh:
         for root, dirs, files in os.walk(CLASSIFIERS_BASE_DIR):
             for file in files:
+                # Models and corpus files are broadcast or shipped separately.
+                if not file.endswith(".py"):
+                    continue
+
                 fullpath = os.path.join(root, file)
                 
                 relpath = os.path.relpath(fullpath, CLASSIFIERS_BASE_DIR)
@@ -58,15 +78,21 @@ def get_es_conf():
     return es_conf
 
 
-def get_save_action(tweet):
-    return {
+def get_save_action(tweet, index=sa.INDEX_NAME):
+    action = {
         "_op_type": "update",
         "_id": tweet.id,
-        "_index": sa.INDEX_NAME,
+        "_index": index,
         "_type": sa.DOCUMENT_TYPE,
         "doc": tweet.data,
     }
 
+    if index != sa.INDEX_NAME:
+        # Scratch indices start out empty, updates create the documents.
+        action["doc_as_upsert"] = True
+
+    return action
+
 
 def get_spark_context():
     spark_conf = SparkConf()
@@ -79,7 +105,100 @@ def get_spark_context():
     return sc
 
 
-def run_analysis(sc, classifier, es_conf):
+def get_model_broadcast(sc):
+    if not is_model_broadcast():
+        return None
+
+    model = classifiers.naive_bayes.engine.load_model(NAIVE_BAYES_MODEL_FILENAME)
+    model = model._replace(
+        log_priors=numpy.array(model.log_priors),
+        log_likelihoods=numpy.array(model.log_likelihoods),
+    )
+
+    sa.logger.info("Broadcasting naive Bayes model with {} words ...".format(len(model.vocabulary)))
+    return sc.broadcast(model)
+
+
+def get_model_loader(sc, model_broadcast):
+    loads = sc.accumulator(0)
+    load_seconds = sc.accumulator(0.0)
+    max_rss_kib = sc.accumulator(0)
+
+    def load_model():
+        # Runs on the executors, the model is set once per Python worker.
+        if model_broadcast is None:
+            return
+
+        if classifiers.naive_bayes.naive_bayes.cached_model is not None:
+            return
+
+        start = time.perf_counter()
+        classifiers.naive_bayes.naive_bayes.set_model(model_broadcast.value)
+
+        loads.add(1)
+        load_seconds.add(time.perf_counter() - start)
+        max_rss_kib.add(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def log_stats():
+        if not loads.value:
+            return
+
+        sa.logger.info("Model loaded by {} executor processes in {:.3f} s on average, {:.0f} MiB peak memory on average".format(
+            loads.value,
+            load_seconds.value / loads.value,
+            max_rss_kib.value / loads.value / 1024,
+        ))
+
+    return load_model, log_stats
+
+
+def is_model_broadcast():
+    # Only naive Bayes has a model, polarity uses the lexicon that comes
+    # with TextBlob on every executor and has nothing to broadcast.
+    return config["classifier"] == "naive_bayes" and os.path.exists(NAIVE_BAYES_MODEL_FILENAME)
+
+
+def is_trained_on_executors():
+    return config["classifier"] == "naive_bayes" and not is_model_broadcast()
+
+
+def clear_compare_index(db, index):
+    try:
+        db.indices.delete(index=index)
+    except elasticsearch.exceptions.NotFoundError:
+        pass
+
+
+def compare_writes(sc, classifier, es_conf, load_model):
+    """Runs the analysis once with driver and once with executor writes.
+
+    Both passes write to their own scratch index, so both read the same
+    unclassified tweets instead of the second pass finding none left.
+    """
+    db = sa.get_database(config["database"]["host"])
+    throughputs = {}
+
+    for name, executor_writes in (("driver", False), ("executors", True)):
+        index = COMPARE_INDEX_NAME.format(name)
+        clear_compare_index(db, index)
+
+        try:
+            count, duration = run_analysis(sc, classifier, es_conf, load_model, executor_writes, index)
+        finally:
+            clear_compare_index(db, index)
+
+        throughputs[name] = count / duration if duration else 0
+
+    if not throughputs["driver"]:
+        sa.logger.warning("Nothing was written, no tweets to compare with")
+        return
+
+    sa.logger.info("Executor writes: {:.1f}x the throughput of driver writes".format(
+        throughputs["executors"] / throughputs["driver"],
+    ))
+
+
+def get_classified_actions(sc, classifier, es_conf, load_model, index=sa.INDEX_NAME):
     rdd = sc.newAPIHadoopRDD(
         inputFormatClass="org.elasticsearch.hadoop.mr.EsInputFormat",
         keyClass="org.apache.hadoop.io.NullWritable",
@@ -90,16 +209,59 @@ def run_analysis(sc, classifier, es_conf):
     rdd = rdd.map(tweet_document_named_tuple)
     rdd = rdd.filter(lambda x: not sa.is_spam_tweet(x))
     rdd = rdd.map(sa.get_url_filtered_tweet)
-    rdd = rdd.map(lambda x: sa.get_classified_tweet(classifier, config["classifier"], x))
-    rdd = rdd.map(get_save_action)
-    
-    db = sa.get_database(config["database"]["host"])
+    rdd = rdd.mapPartitions(lambda x: get_classified_partition(classifier, load_model, x))
+    rdd = rdd.map(lambda x: get_save_action(x, index))
 
-    sa.elasticsearch.helpers.bulk(
-        db,
-        rdd.toLocalIterator(),
-        chunk_size=sa.UPDATE_CHUNK_SIZE,
-    )
+    return rdd
+
+
+def get_classified_partition(classifier, load_model, tweets):
+    load_model()
+    return sa.get_classified_tweets(classifier, config, tweets)
+
+
+def run_analysis(sc, classifier, es_conf, load_model, executor_writes=True, index=sa.INDEX_NAME):
+    rdd = get_classified_actions(sc, classifier, es_conf, load_model, index)
+    start = time.perf_counter()
+
+    if executor_writes:
+        count = save_from_executors(sc, rdd, config["database"]["host"])
+    else:
+        count = save_from_driver(rdd, config["database"]["host"])
+
+    duration = time.perf_counter() - start
+
+    sa.logger.info("Wrote {} updates to {} from the {} in {:.1f} s ({:.0f} updates/s)".format(
+        count,
+        index,
+        "executors" if executor_writes else "driver",
+        duration,
+        count / duration if duration else 0,
+    ))
+
+    return count, duration
+
+
+def save_from_driver(rdd, host):
+    # Funnels every update through the driver, kept for comparison.
+    db = sa.get_database(host)
+    count, errors = bulk_writer.bulk(db, rdd.toLocalIterator(), chunk_size=sa.UPDATE_CHUNK_SIZE)
+
+    return count
+
+
+def save_from_executors(sc, rdd, host):
+    written = sc.accumulator(0)
+
+    def save_partition(actions):
+        # Runs on the executors, every Python worker keeps its connection.
+        db = sa.get_cached_database(host)
+        count, errors = bulk_writer.bulk(db, actions, chunk_size=sa.UPDATE_CHUNK_SIZE)
+        written.add(count)
+
+    rdd.foreachPartition(save_partition)
+
+    return written.value
 
 
 def tweet_document_named_tuple(x):
@@ -107,14 +269,25 @@ def tweet_document_named_tuple(x):
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compare", action="store_true", help="compare the throughput of driver and executor writes on scratch indices")
+
+    args = parser.parse_args()
+
     sa.load_spam_filters()
+    sa.put_class_mapping(sa.get_database(config["database"]["host"]), config)
 
     sc = get_spark_context()
-    classifier = getattr(classifiers, config["classifier"]).classify
+    classifier = sa.get_classifier(config)
     es_conf = get_es_conf()
+    load_model, log_model_stats = get_model_loader(sc, get_model_broadcast(sc))
     
-    run_analysis(sc, classifier, es_conf)
+    if args.compare:
+        compare_writes(sc, classifier, es_conf, load_model)
+    else:
+        run_analysis(sc, classifier, es_conf, load_model)
     
+    log_model_stats()
     sc.stop()
 
 
@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import bulk_writer
+
+
+def get_streaming_bulk(statuses):
+    """Stands in for elasticsearch.helpers.streaming_bulk().
+
+    Every request takes the statuses of the next list in statuses, one per
+    action, and the actions sent are recorded in requests.
+    """
+    requests = []
+
+    def streaming_bulk(client, actions, **kwargs):
+        actions = list(actions)
+        requests.append(actions)
+
+        for action, status in zip(actions, statuses[len(requests) - 1]):
+            yield 200 <= status < 300, {"update": {"_id": action["_id"], "status": status}}
+
+    return streaming_bulk, requests
+
+
+class SendChunkTest(unittest.TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch.object(bulk_writer, "RETRY_DELAY_SECONDS", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.chunk = [{"_id": str(idx)} for idx in range(4)]
+
+    def send_chunk(self, statuses):
+        streaming_bulk, requests = get_streaming_bulk(statuses)
+
+        with unittest.mock.patch.object(bulk_writer.elasticsearch.helpers, "streaming_bulk", streaming_bulk):
+            result = bulk_writer.send_chunk(None, self.chunk, 100)
+
+        return result, requests
+
+    def test_retries_rejected_actions(self):
+        result, requests = self.send_chunk([[200, 429, 200, 503], [429, 200], [200]])
+
+        self.assertEqual(requests[1:], [[{"_id": "1"}, {"_id": "3"}], [{"_id": "1"}]])
+        self.assertEqual(result.success, 4)
+        self.assertEqual(result.errors, [])
+        self.assertTrue(result.failed)
+
+    def test_gives_up_on_rejected_actions(self):
+        result, requests = self.send_chunk([[200, 429, 200, 200]] + [[429]] * bulk_writer.MAX_RETRIES)
+
+        self.assertEqual(len(requests), bulk_writer.MAX_RETRIES + 1)
+        self.assertEqual(result.success, 3)
+        self.assertEqual([error["update"]["_id"] for error in result.errors], ["1"])
+
+    def test_does_not_retry_invalid_actions(self):
+        result, requests = self.send_chunk([[200, 400, 200, 200]])
+
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(result.success, 3)
+        self.assertEqual([error["update"]["_id"] for error in result.errors], ["1"])
+        self.assertFalse(result.failed)
+
+
+class GetChunksTest(unittest.TestCase):
+    def test_estimates_chunk_sizes(self):
+        actions = [{"_id": str(idx), "doc": {"text": "x" * 100}} for idx in range(1000)]
+        chunks = list(bulk_writer.get_chunks(actions, lambda: 300))
+
+        self.assertEqual([len(chunk) for chunk, size_bytes in chunks], [300, 300, 300, 100])
+        self.assertEqual([action for chunk, size_bytes in chunks for action in chunk], actions)
+
+        # The actions are nearly the same size, so sampling is close to exact.
+        for chunk, size_bytes in chunks:
+            exact = sum(len(bulk_writer.json.dumps(action)) for action in chunk)
+            self.assertAlmostEqual(size_bytes / exact, 1, places=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+import functools
+import os
+import sys
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import aggregator
+import local_aggregator
+
+
+CHUNK_SIZES = (1, 2, 3, 100)
+CONFIG = {
+    "classifier": "naive_bayes",
+    "aggregation": {
+        "time_interval_minutes": 10,
+        "classifiers": ["polarity"],
+    },
+}
+SINCE = 1464775200000 # 2016-06-01T10:00:00Z
+
+# Tweet sources in the formats they are stored in: dates with microseconds,
+# with a Z suffix and as epoch millis, classes missing or empty.
+TWEETS = (
+    {"date": "2016-06-01T09:55:00", "sentiment_class_naive_bayes": "pos", "sentiment_class_polarity": "pos"},
+    {"date": "2016-06-01T10:01:02.500000", "sentiment_class_naive_bayes": "pos", "sentiment_class_polarity": "pos"},
+    {"date": "2016-06-01T10:04:00Z", "sentiment_class_naive_bayes": "neg", "sentiment_class_polarity": "pos"},
+    {"date": "2016-06-01T10:09:59.999000", "sentiment_class_naive_bayes": "pos", "sentiment_class_polarity": "neutral"},
+    {"date": 1464775500000, "sentiment_class_naive_bayes": "neutral"},
+    {"date": "2016-06-01T10:31:00", "sentiment_class_naive_bayes": "neg", "sentiment_class_polarity": "neg"},
+    {"date": "2016-06-01T10:35:00", "sentiment_class_naive_bayes": "", "sentiment_class_polarity": "neg"},
+    {"sentiment_class_naive_bayes": "pos", "sentiment_class_polarity": "pos"},
+)
+
+# What Elasticsearch 2.x answers to get_aggregation_body(CONFIG, SINCE)
+# over TWEETS, the buckets of 10:10 and 10:20 are empty.
+TWEET_RESPONSE = {
+    "took": 3,
+    "timed_out": False,
+    "_shards": {"total": 5, "successful": 5, "failed": 0},
+    "hits": {"total": 6, "max_score": 0.0, "hits": []},
+    "aggregations": {
+        "by_time": {
+            "buckets": [
+                {
+                    "key_as_string": "2016-06-01T10:00:00.000Z",
+                    "key": 1464775200000,
+                    "doc_count": 4,
+                    "by_sentiment_naive_bayes": {
+                        "doc_count_error_upper_bound": 0,
+                        "sum_other_doc_count": 0,
+                        "buckets": [
+                            {"key": "pos", "doc_count": 2},
+                            {"key": "neg", "doc_count": 1},
+                            {"key": "neutral", "doc_count": 1},
+                        ],
+                    },
+                    "by_sentiment_polarity": {
+                        "doc_count_error_upper_bound": 0,
+                        "sum_other_doc_count": 0,
+                        "buckets": [
+                            {"key": "pos", "doc_count": 2},
+                            {"key": "neutral", "doc_count": 1},
+                        ],
+                    },
+                },
+                {
+                    "key_as_string": "2016-06-01T10:10:00.000Z",
+                    "key": 1464775800000,
+                    "doc_count": 0,
+                    "by_sentiment_naive_bayes": {"doc_count_error_upper_bound": 0, "sum_other_doc_count": 0, "buckets": []},
+                    "by_sentiment_polarity": {"doc_count_error_upper_bound": 0, "sum_other_doc_count": 0, "buckets": []},
+                },
+                {
+                    "key_as_string": "2016-06-01T10:20:00.000Z",
+                    "key": 1464776400000,
+                    "doc_count": 0,
+                    "by_sentiment_naive_bayes": {"doc_count_error_upper_bound": 0, "sum_other_doc_count": 0, "buckets": []},
+                    "by_sentiment_polarity": {"doc_count_error_upper_bound": 0, "sum_other_doc_count": 0, "buckets": []},
+                },
+                {
+                    "key_as_string": "2016-06-01T10:30:00.000Z",
+                    "key": 1464777000000,
+                    "doc_count": 2,
+                    "by_sentiment_naive_bayes": {
+                        "doc_count_error_upper_bound": 0,
+                        "sum_other_doc_count": 0,
+                        "buckets": [
+                            {"key": "neg", "doc_count": 1},
+                        ],
+                    },
+                    "by_sentiment_polarity": {
+                        "doc_count_error_upper_bound": 0,
+                        "sum_other_doc_count": 0,
+                        "buckets": [
+                            {"key": "neg", "doc_count": 2},
+                        ],
+                    },
+                },
+            ],
+        },
+    },
+}
+
+# Stock prices, filtered by a bool query with a range and a match_phrase.
+PRICE_BODY = {
+    "size": 0,
+    "query": {
+        "bool": {
+            "filter": [
+                {"range": {"date": {"gte": "2016-06-01T13:00:00", "lt": 1464793200000, "format": "strict_date_optional_time||epoch_millis"}}},
+                {"match_phrase": {"ticker_symbol": "AAPL"}},
+            ],
+        },
+    },
+    "aggs": {
+        "by_time": {
+            "date_histogram": {"field": "date", "interval": "30m"},
+            "aggs": {
+                "avg_value": {"avg": {"field": "price"}},
+            },
+        },
+    },
+}
+PRICES = (
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T12:59:59.999999", "price": 99.0},
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T13:10:00.123456", "price": 100.5},
+    {"ticker_symbol": "GOOG", "date": "2016-06-01T13:20:00.000000", "price": 700.0},
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T13:25:00.000000", "price": 101.0},
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T14:40:00.000000", "price": 102.25},
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T14:50:00.000000", "price": None},
+    {"ticker_symbol": "AAPL", "date": "2016-06-01T15:00:00.000000", "price": 103.0},
+)
+
+# What Elasticsearch 2.x answers to PRICE_BODY over PRICES.
+PRICE_RESPONSE = {
+    "took": 1,
+    "timed_out": False,
+    "_shards": {"total": 5, "successful": 5, "failed": 0},
+    "hits": {"total": 4, "max_score": 0.0, "hits": []},
+    "aggregations": {
+        "by_time": {
+            "buckets": [
+                {"key_as_string": "2016-06-01T13:00:00.000Z", "key": 1464786000000, "doc_count": 2, "avg_value": {"value": 100.75}},
+                {"key_as_string": "2016-06-01T13:30:00.000Z", "key": 1464787800000, "doc_count": 0, "avg_value": {"value": None}},
+                {"key_as_string": "2016-06-01T14:00:00.000Z", "key": 1464789600000, "doc_count": 0, "avg_value": {"value": None}},
+                {"key_as_string": "2016-06-01T14:30:00.000Z", "key": 1464791400000, "doc_count": 2, "avg_value": {"value": 102.25}},
+            ],
+        },
+    },
+}
+
+
+class FakeElasticsearch:
+    def __init__(self, response):
+        self.response = response
+
+    def search(self, **kwargs):
+        return self.response
+
+
+class LocalAggregatorTest(unittest.TestCase):
+    def assert_same_response(self, rows, body, expected):
+        for chunk_size in CHUNK_SIZES:
+            response = local_aggregator.search(iter(rows), body, chunk_size)
+
+            self.assertEqual(response["hits"]["total"], expected["hits"]["total"])
+            self.assertEqual(response["aggregations"], expected["aggregations"])
+
+    def test_matches_elasticsearch_terms_response(self):
+        body = aggregator.get_aggregation_body(CONFIG, SINCE)
+        self.assert_same_response(TWEETS, body, TWEET_RESPONSE)
+
+    def test_matches_elasticsearch_avg_response(self):
+        self.assert_same_response(PRICES, PRICE_BODY, PRICE_RESPONSE)
+
+    def test_aggregated_documents_match_elasticsearch_response(self):
+        expected = tuple(aggregator.get_aggregated_documents(FakeElasticsearch(TWEET_RESPONSE), CONFIG, SINCE))
+
+        for chunk_size in CHUNK_SIZES:
+            search = functools.partial(local_aggregator.search, chunk_size=chunk_size)
+
+            with unittest.mock.patch.object(local_aggregator, "search", search):
+                documents = tuple(aggregator.get_aggregated_documents(None, CONFIG, SINCE, iter(TWEETS)))
+
+            self.assertEqual(documents, expected)
+
+        self.assertEqual(expected[0], {
+            "date": "2016-06-01T10:00:00.000Z",
+            "pos": 2,
+            "neg": 1,
+            "neutral": 1,
+            "sentiment_relation": 2 / 3,
+            "sentiment_relation_naive_bayes": 2 / 3,
+        })
+        self.assertEqual(expected[1], {"date": "2016-06-01T10:10:00.000Z"})
+
+    def test_rejects_unsupported_bodies(self):
+        body = dict(PRICE_BODY, query={"bool": {"should": [{"match_all": {}}]}})
+
+        with self.assertRaises(ValueError):
+            local_aggregator.search(iter(PRICES), body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "classifiers", "naive_bayes"))
+
+import engine
+import naive_bayes
+
+
+LABELED_SENTENCES = (
+    ("pos", "What a great day, I love it"),
+    ("pos", "Great news, great stock"),
+    ("pos", "love love love"),
+    ("pos", "!!! :)"),
+    ("neg", "What a terrible day, I hate it"),
+    ("neg", "Terrible news for the stock"),
+    ("neg", "quixotic zephyr"),
+    ("neg", "1234"),
+    ("neutral", "The stock closed at 100 today"),
+    ("neutral", "News at noon"),
+    ("neutral", "the and of"),
+    ("neutral", "zephyr"),
+)
+VOCABULARY_SIZE = 8
+
+
+class NaiveBayesTest(unittest.TestCase):
+    def assert_same_posteriors(self, classifier, model, sentences):
+        max_error = naive_bayes.get_max_posterior_error(classifier, model, sentences)
+        self.assertLess(max_error, 1e-9)
+
+    def test_converted_model_matches_nltk(self):
+        with unittest.mock.patch.object(naive_bayes, "WORD_SAMPLE_SIZE", VOCABULARY_SIZE):
+            classifier = naive_bayes.train_nltk_classifier(LABELED_SENTENCES)
+
+        model = engine.get_model_from_nltk_classifier(classifier)
+        sentences = [sentence for label, sentence in LABELED_SENTENCES] + ["", "unknown words only"]
+
+        self.assert_same_posteriors(classifier, model, sentences)
+
+    def test_converted_model_matches_nltk_on_corpus(self):
+        labeled_sentences = tuple(naive_bayes.get_labeled_sentences())
+        classifier = naive_bayes.train_nltk_classifier(labeled_sentences)
+        model = engine.get_model_from_nltk_classifier(classifier)
+
+        sentences = naive_bayes.TEST_SENTENCES + tuple(sentence for label, sentence in labeled_sentences)
+        self.assert_same_posteriors(classifier, model, sentences)
+
+    def test_counted_model_matches_nltk(self):
+        # A small vocabulary leaves sentences without any word of it, and
+        # sentences without any words at all are trained on the empty word.
+        with unittest.mock.patch.object(naive_bayes, "WORD_SAMPLE_SIZE", VOCABULARY_SIZE):
+            classifier = naive_bayes.train_nltk_classifier(LABELED_SENTENCES)
+
+        counts = engine.get_empty_counts()
+        naive_bayes.partial_fit(counts, LABELED_SENTENCES)
+        model = engine.get_model_from_counts(counts, VOCABULARY_SIZE)
+
+        self.assertEqual(set(model.vocabulary), set(fname for label, fname in classifier._feature_probdist))
+        self.assert_same_posteriors(classifier, model, [sentence for label, sentence in LABELED_SENTENCES])
+
+    def test_counted_model_matches_nltk_on_corpus(self):
+        labeled_sentences = tuple(naive_bayes.get_labeled_sentences())
+        classifier = naive_bayes.train_nltk_classifier(labeled_sentences)
+
+        counts = engine.get_empty_counts()
+        naive_bayes.partial_fit(counts, labeled_sentences)
+        model = engine.get_model_from_counts(counts, naive_bayes.WORD_SAMPLE_SIZE)
+
+        sentences = naive_bayes.TEST_SENTENCES + tuple(sentence for label, sentence in labeled_sentences)
+        self.assert_same_posteriors(classifier, model, sentences)
+
+    def test_merged_counts_match_serial_counts(self):
+        serial = engine.get_empty_counts()
+        naive_bayes.partial_fit(serial, LABELED_SENTENCES)
+
+        merged = engine.get_empty_counts()
+
+        for start in range(0, len(LABELED_SENTENCES), 5):
+            shard = engine.get_empty_counts()
+            naive_bayes.partial_fit(shard, LABELED_SENTENCES[start:start + 5])
+            engine.merge_counts(merged, shard)
+
+        self.assertEqual(list(merged.word_counts.items()), list(serial.word_counts.items()))
+        self.assertEqual(dict(merged.word_sets), dict(serial.word_sets))
+
+    def test_saving_keeps_loaded_models_readable(self):
+        counts = engine.get_empty_counts()
+        naive_bayes.partial_fit(counts, LABELED_SENTENCES)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, naive_bayes.MODEL_FILENAME)
+
+        engine.save_model(engine.get_model_from_counts(counts, VOCABULARY_SIZE), filename)
+        loaded = engine.load_model(filename)
+        log_likelihoods = loaded.log_likelihoods.copy()
+
+        # Rewriting the mapped file in place changes or truncates what the
+        # loaded model reads, a new file leaves it untouched.
+        engine.save_model(engine.get_model_from_counts(counts, 2), filename)
+
+        self.assertEqual(loaded.log_likelihoods.tolist(), log_likelihoods.tolist())
+        self.assertEqual(len(engine.load_model(filename).vocabulary), 2)
+        self.assertEqual(os.listdir(directory.name), [naive_bayes.MODEL_FILENAME])
+
+
+if __name__ == "__main__":
+    unittest.main()
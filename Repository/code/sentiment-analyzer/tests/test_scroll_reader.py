@@ -0,0 +1,99 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import scroll_reader
+
+
+CONTEXT_TIMEOUT = "1m"
+LATENCY_S = 0.05
+PAGE_COUNT = 20
+PAGE_SIZE = 10
+
+
+class FakeElasticsearch:
+    """Serves PAGE_COUNT scroll pages, every request takes LATENCY_S."""
+
+    def __init__(self, fail_at_page=None):
+        self.fail_at_page = fail_at_page
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def search(self, **kwargs):
+        time.sleep(LATENCY_S)
+        return {"_scroll_id": "0", "hits": {"total": PAGE_COUNT * PAGE_SIZE, "hits": []}}
+
+    def scroll(self, scroll_id, scroll):
+        time.sleep(LATENCY_S)
+
+        with self.lock:
+            self.requests += 1
+
+        page = int(scroll_id)
+
+        if page == self.fail_at_page:
+            raise ConnectionError("scroll context lost")
+
+        if page == PAGE_COUNT:
+            hits = []
+        else:
+            hits = [{"_id": str(page * PAGE_SIZE + idx)} for idx in range(PAGE_SIZE)]
+
+        return {"_scroll_id": str(page + 1), "hits": {"total": PAGE_COUNT * PAGE_SIZE, "hits": hits}}
+
+
+def read_pages(db, prefetch_pages):
+    response = db.search()
+    ids = []
+
+    for page in scroll_reader.get_scroll_pages(db, response, CONTEXT_TIMEOUT, prefetch_pages):
+        # As long as a round-trip, like classifying a page.
+        time.sleep(LATENCY_S)
+        ids.extend(hit["_id"] for hit in page["hits"]["hits"])
+
+    return ids
+
+
+class ScrollReaderTest(unittest.TestCase):
+    def test_yields_all_pages_in_order(self):
+        ids = read_pages(FakeElasticsearch(), 4)
+        self.assertEqual(ids, [str(idx) for idx in range(PAGE_COUNT * PAGE_SIZE)])
+
+    def test_overlaps_requests_with_processing(self):
+        start = time.monotonic()
+        read_pages(FakeElasticsearch(), 4)
+        duration = time.monotonic() - start
+
+        # Fetching and processing one after the other takes two latencies
+        # per page, prefetching hides most of the fetching.
+        sequential_duration = 2 * PAGE_COUNT * LATENCY_S
+        self.assertLess(duration, sequential_duration * 0.8)
+
+    def test_raises_fetch_errors_in_reader(self):
+        with self.assertRaises(ConnectionError):
+            read_pages(FakeElasticsearch(fail_at_page=5), 4)
+
+    def test_stops_prefetching_when_closed(self):
+        db = FakeElasticsearch()
+        response = db.search()
+        pages = scroll_reader.get_scroll_pages(db, response, CONTEXT_TIMEOUT, 2)
+
+        next(pages)
+        pages.close()
+
+        # The thread notices within one queue poll and sends no more requests.
+        time.sleep(scroll_reader.QUEUE_POLL_SECONDS + 2 * LATENCY_S)
+        requests = db.requests
+        time.sleep(scroll_reader.QUEUE_POLL_SECONDS + 2 * LATENCY_S)
+
+        self.assertEqual(db.requests, requests)
+        self.assertLess(requests, PAGE_COUNT)
+        self.assertNotIn("scroll-prefetch", [thread.name for thread in threading.enumerate()])
+
+
+if __name__ == "__main__":
+    unittest.main()
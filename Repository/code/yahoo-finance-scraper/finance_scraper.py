@@ -1,23 +1,114 @@
+import argparse
 import collections
+import concurrent.futures
 import datetime
+import glob
+import json
 import logging
+import math
 import os
+import queue
+import random
+import threading
 import time
 
 import elasticsearch
+import elasticsearch.helpers
 import ruamel.yaml as yaml
 import yahoo_finance
 
 
+BASEDIR = os.path.dirname(__file__)
+DOCUMENT_TYPE = "stock_price"
+INDEX_NAME = "stock_data"
+MAX_CONCURRENT_REQUESTS = 16
+MAX_QUEUED_BATCHES = 100
+MAX_SPOOLED_BATCHES = 10000
 OFF_DAY_INTERVAL = 3600
+REPLAY_BATCHES = 50
+REQUEST_TIMEOUT = 10
+RETRY_DELAY_SECONDS = 5
+SPOOL_CORRUPT_SUFFIX = ".corrupt"
+SPOOL_DIR = os.path.join(BASEDIR, "spool")
+SPOOL_FILENAME_FORMAT = "{:012d}.json"
+SPOOL_FILENAME_PATTERN = "*.json"
 StockInfo = collections.namedtuple("StockInfo", ("symbol", "price", "date"))
 
 
-def fetch_stock_info(ticker_symbol):
+def collect_stock_info(future, ticker_symbol, results):
+    try:
+        results.append(future.result())
+    except Exception:
+        logger.exception("Error while fetching {}".format(ticker_symbol))
+
+
+def fetch_all_stock_info(executor, max_workers, pending, ticker_symbols, get_price, timeout):
+    """Fetches the quotes of all ticker symbols from the executor's threads.
+
+    Returns the StockInfo of every quote fetched. Fetches are only handed
+    to the executor while one of its max_workers threads is free, so the
+    timeout of each one counts from when it starts. yahoo_finance takes no
+    timeout, so this is the only one. Slower fetches stay in pending and
+    their symbols are skipped until they are done, their quotes are
+    returned by the next sweep after that. Symbols that never got a free
+    thread because all of them were hanging are skipped for this sweep.
+    """
+    queued = collections.deque()
+    results = []
+
+    for ticker_symbol in ticker_symbols:
+        if ticker_symbol not in pending:
+            queued.append(ticker_symbol)
+        elif pending[ticker_symbol].done():
+            collect_stock_info(pending.pop(ticker_symbol), ticker_symbol, results)
+        else:
+            logger.warning("Still fetching {} from an earlier sweep, skipping it".format(ticker_symbol))
+
+    running = {}
+
+    while True:
+        # Hanging fetches of earlier sweeps still take up their threads.
+        busy = sum(not future.done() for future in pending.values())
+
+        while queued and busy + len(running) < max_workers:
+            ticker_symbol = queued.popleft()
+            future = executor.submit(fetch_stock_info, ticker_symbol, get_price)
+            running[future] = (ticker_symbol, time.monotonic())
+
+        now = time.monotonic()
+        deadlines = [start + timeout for ticker_symbol, start in running.values() if start + timeout > now]
+
+        # Done once every running fetch has finished or timed out.
+        if not deadlines:
+            break
+
+        done, not_done = concurrent.futures.wait(
+            running,
+            timeout=min(deadlines) - now,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+
+        for future in done:
+            ticker_symbol, start = running.pop(future)
+            collect_stock_info(future, ticker_symbol, results)
+
+    for future, (ticker_symbol, start) in running.items():
+        if future.done():
+            collect_stock_info(future, ticker_symbol, results)
+        else:
+            logger.warning("Fetching {} timed out after {} s".format(ticker_symbol, timeout))
+            pending[ticker_symbol] = future
+
+    if queued:
+        logger.warning("All threads are stuck on timed out fetches, skipping {} symbols".format(len(queued)))
+
+    return results
+
+
+def fetch_stock_info(ticker_symbol, get_price):
     logger.debug("Fetching {} data ...".format(ticker_symbol))
     now = datetime.datetime.utcnow()
-    share = yahoo_finance.Share(ticker_symbol)
-    price = share.get_price()
+    price = get_price(ticker_symbol)
     
     try:
         price = float(price)
@@ -31,6 +122,69 @@ def fetch_stock_info(ticker_symbol):
     return stock_info
 
 
+def flush_spool(db, spool_dir):
+    """Saves the oldest spooled batches with one bulk request.
+    
+    Returns None if the spool is empty, True if batches were saved and
+    False if Elasticsearch could not be reached or rejected quotes for now.
+    Rejected quotes (429 and 5xx) stay spooled in the oldest batch file and
+    are sent again first, anything else that failed is logged and dropped.
+    """
+    filenames = []
+    actions = []
+    
+    for filename in get_spool_filenames(spool_dir)[:REPLAY_BATCHES]:
+        batch = read_spooled_batch(filename)
+        
+        if batch is not None:
+            filenames.append(filename)
+            actions.extend(batch)
+    
+    if not filenames:
+        return None
+    
+    try:
+        # One request for everything, so a failed request saved nothing.
+        results = tuple(elasticsearch.helpers.streaming_bulk(
+            db,
+            actions,
+            chunk_size=max(len(actions), 1),
+            raise_on_error=False,
+        ))
+    except elasticsearch.exceptions.ElasticsearchException as e:
+        logger.warning("Cannot save {} quotes ({}), keeping them spooled".format(len(actions), e))
+        return False
+    
+    rejected = []
+    
+    for action, (ok, item) in zip(actions, results):
+        if ok:
+            continue
+        
+        if is_retryable(item):
+            rejected.append(action)
+        else:
+            logger.error("Cannot save quote: {}".format(item))
+    
+    # The oldest file is replaced first, a crash in between only sends
+    # some quotes twice instead of losing any.
+    if rejected:
+        write_spooled_batch(filenames[0], rejected)
+    else:
+        os.remove(filenames[0])
+    
+    for filename in filenames[1:]:
+        os.remove(filename)
+    
+    logger.debug("Saved {} quotes from {} spooled batches".format(len(actions) - len(rejected), len(filenames)))
+    
+    if rejected:
+        logger.warning("{} quotes were rejected, keeping them spooled".format(len(rejected)))
+        return False
+    
+    return True
+
+
 def get_config():
     config_file = os.getenv("SCRAPER_CONFIG", "config.yaml")
     config_file = os.path.abspath(config_file)
@@ -63,6 +217,31 @@ def get_fetch_pause(config):
     return config["scraper"]["interval_s"]
 
 
+def get_save_action(stock_info):
+    return {
+        "_op_type": "index",
+        "_index": INDEX_NAME,
+        "_type": DOCUMENT_TYPE,
+        "ticker_symbol": stock_info.symbol,
+        "date": stock_info.date.isoformat(),
+        "price": stock_info.price,
+    }
+
+
+def get_spool_filenames(spool_dir):
+    return sorted(glob.glob(os.path.join(spool_dir, SPOOL_FILENAME_PATTERN)))
+
+
+def get_stub_price_source(latency_s):
+    # Stands in for Yahoo Finance to try the fetch loop without network
+    # access, every quote takes up to latency_s seconds.
+    def get_price(ticker_symbol):
+        time.sleep(random.uniform(0, latency_s))
+        return str(round(random.uniform(50, 150), 2))
+
+    return get_price
+
+
 def get_logger():
     logger = logging.getLogger("psais.scraper.yahoo.finance")
     logger.setLevel(logging.DEBUG)
@@ -78,7 +257,26 @@ def get_logger():
     return logger
 
 
+def get_yahoo_price(ticker_symbol):
+    share = yahoo_finance.Share(ticker_symbol)
+    return share.get_price()
+
+
+def is_retryable(item):
+    # Bulk items look like {"index": {"status": 429, ...}}. Rejections of a
+    # busy cluster and server errors may work later, bad documents never.
+    op_type, result = next(iter(item.items()))
+    status = result.get("status", 500)
+    
+    return status == 429 or status >= 500
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stub-latency", type=float, metavar="SECONDS", help="fetch random quotes with up to this much latency instead of Yahoo Finance quotes")
+    
+    args = parser.parse_args()
+    
     config = get_config()
     logger.setLevel(config["log_level"])
     
@@ -87,32 +285,174 @@ def main():
     else:
         db = None
     
-    start_scrape_loop(db, config)
+    if args.stub_latency is None:
+        get_price = get_yahoo_price
+    else:
+        get_price = get_stub_price_source(args.stub_latency)
+    
+    start_scrape_loop(db, config, get_price)
+
+
+def read_spooled_batch(filename):
+    # Corrupt files would fail every replay, they are moved aside instead.
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except ValueError as e:
+        logger.error("Cannot read spooled batch {} ({}), moving it aside".format(filename, e))
+        os.replace(filename, filename + SPOOL_CORRUPT_SUFFIX)
+        return None
 
 
-def save_stock_info(db, stock_info):
-    logger.debug("Saving stock info to database")
+def spool_batch(spool_dir, sequence, actions):
+    filename = os.path.join(spool_dir, SPOOL_FILENAME_FORMAT.format(sequence))
+    write_spooled_batch(filename, actions)
+
+
+def start_scrape_loop(db, config, get_price=get_yahoo_price):
+    max_workers = config["scraper"].get("max_concurrent_requests", MAX_CONCURRENT_REQUESTS)
+    timeout = config["scraper"].get("request_timeout_s", REQUEST_TIMEOUT)
+    spool_dir = config["scraper"].get("spool_dir", SPOOL_DIR)
+    max_spooled_batches = config["scraper"].get("max_spooled_batches", MAX_SPOOLED_BATCHES)
+    pending = {}
     
-    body = {
-        "ticker_symbol": stock_info.symbol,
-        "date": stock_info.date,
-        "price": stock_info.price,
-    }
+    if config["scraper"]["save_data"]:
+        batches = queue.Queue(MAX_QUEUED_BATCHES)
+        writer = start_writer(db, batches, spool_dir, max_spooled_batches)
+    else:
+        batches = None
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        next_sweep = time.monotonic()
+        
+        while True:
+            start = time.monotonic()
+            ticker_symbols = config["scraper"]["ticker_symbols"]
+            stock_infos = fetch_all_stock_info(executor, max_workers, pending, ticker_symbols, get_price, timeout)
+            
+            logger.debug("Fetched {}/{} quotes in {:.2f} s".format(len(stock_infos), len(ticker_symbols), time.monotonic() - start))
+            
+            # Handed to the writer thread, saving never delays the next sweep.
+            actions = [get_save_action(stock_info) for stock_info in stock_infos if stock_info.price]
+            
+            if batches is not None:
+                if not writer.is_alive():
+                    logger.error("Quote writer died, restarting it ...")
+                    writer = start_writer(db, batches, spool_dir, max_spooled_batches)
+                
+                if actions:
+                    try:
+                        batches.put_nowait(actions)
+                    except queue.Full:
+                        logger.warning("{} batches are waiting to be spooled, dropping {} quotes".format(MAX_QUEUED_BATCHES, len(actions)))
+            
+            # Sweeps start at a fixed rate, the time spent fetching counts
+            # towards the pause. Sweeps that would have started while the
+            # last one was still running are skipped.
+            interval = get_fetch_pause(config)
+            next_sweep += interval
+            now = time.monotonic()
+            
+            if next_sweep < now:
+                missed = math.ceil((now - next_sweep) / interval)
+                logger.warning("Sweep took {:.2f} s, skipping {} sweeps".format(now - start, missed))
+                next_sweep += missed * interval
+            
+            duration = next_sweep - time.monotonic()
+            logger.debug("Sleeping for {:.2f} s ...".format(duration))
+            time.sleep(max(duration, 0))
+
+
+def start_writer(db, batches, spool_dir, max_spooled_batches):
+    os.makedirs(spool_dir, exist_ok=True)
+    
+    thread = threading.Thread(
+        target=write_batches,
+        args=(db, batches, spool_dir, max_spooled_batches),
+        name="quote-writer",
+        daemon=True,
+    )
+    thread.start()
+    
+    return thread
+
+
+def trim_spool(spool_dir, max_spooled_batches):
+    # Keeps the disk from filling up during a long outage, at the cost of
+    # the oldest quotes.
+    filenames = get_spool_filenames(spool_dir)
+    excess = filenames[:max(len(filenames) - max_spooled_batches, 0)]
+    
+    if not excess:
+        return
+    
+    logger.error("Spool is full, dropping the {} oldest batches".format(len(excess)))
     
-    db.index(index="stock_data", doc_type="stock_price", body=body)
+    for filename in excess:
+        os.remove(filename)
 
 
-def start_scrape_loop(db, config):
+def write_batches(db, batches, spool_dir, max_spooled_batches):
+    """Saves the batches of quotes put into the queue on the writer thread.
+    
+    Every batch is spooled to disk before it is sent. While Elasticsearch
+    is slow or unreachable the batches pile up in the spool, and they are
+    replayed oldest first once it is back, the oldest are dropped once
+    there are more than max_spooled_batches. Batches left over from an
+    earlier run are replayed as well. Errors are logged and retried, so
+    the thread keeps running.
+    """
+    filenames = get_spool_filenames(spool_dir)
+    
+    if filenames:
+        logger.info("Replaying {} spooled batches ...".format(len(filenames)))
+        sequence = int(os.path.basename(filenames[-1]).split(".")[0]) + 1
+    else:
+        sequence = 0
+    
+    wait = 0
+    
     while True:
-        for ticker_symbol in config["scraper"]["ticker_symbols"]:
-            stock_info = fetch_stock_info(ticker_symbol)
+        # Waits up to wait seconds (forever if None) for the next batch,
+        # then spools everything that is queued.
+        block = wait != 0
+        
+        while True:
+            try:
+                batch = batches.get(block=block, timeout=wait)
+            except queue.Empty:
+                break
             
-            if config["scraper"]["save_data"] and stock_info.price:
-                save_stock_info(db, stock_info)
+            try:
+                spool_batch(spool_dir, sequence, batch)
+            except Exception:
+                logger.exception("Cannot spool {} quotes, dropping them".format(len(batch)))
+            
+            sequence += 1
+            block = False
+        
+        try:
+            trim_spool(spool_dir, max_spooled_batches)
+            result = flush_spool(db, spool_dir)
+        except Exception:
+            logger.exception("Cannot save spooled batches, retrying in {} s".format(RETRY_DELAY_SECONDS))
+            result = False
         
-        duration = get_fetch_pause(config)
-        logger.debug("Sleeping for {} s ...".format(duration))
-        time.sleep(duration)
+        if result is None:
+            wait = None
+        elif result:
+            wait = 0
+        else:
+            wait = RETRY_DELAY_SECONDS
+
+
+def write_spooled_batch(filename, actions):
+    # Written under a temporary name first, so the replay never sees a
+    # partial file.
+    with open(filename + ".tmp", "w") as fh:
+        json.dump(actions, fh)
+    
+    os.replace(filename + ".tmp", filename)
 
 
 logger = get_logger()
@@ -0,0 +1,232 @@
+import concurrent.futures
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import finance_scraper
+
+
+LATENCY_S = 0.2
+TICKER_SYMBOLS = tuple("SYM{}".format(idx) for idx in range(20))
+
+
+def get_stub_price_source(latencies, default_latency=LATENCY_S):
+    # Quotes of a fixed price that take the given number of seconds per symbol.
+    def get_price(ticker_symbol):
+        time.sleep(latencies.get(ticker_symbol, default_latency))
+        return "100.5"
+
+    return get_price
+
+
+class FetchAllStockInfoTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(len(TICKER_SYMBOLS))
+        self.addCleanup(self.executor.shutdown)
+
+    def test_fetches_concurrently(self):
+        get_price = get_stub_price_source({})
+        pending = {}
+
+        start = time.monotonic()
+        stock_infos = finance_scraper.fetch_all_stock_info(self.executor, len(TICKER_SYMBOLS), pending, TICKER_SYMBOLS, get_price, 5)
+        duration = time.monotonic() - start
+
+        self.assertEqual(sorted(stock_info.symbol for stock_info in stock_infos), sorted(TICKER_SYMBOLS))
+        self.assertTrue(all(stock_info.price == 100.5 for stock_info in stock_infos))
+        self.assertEqual(pending, {})
+
+        # One after the other this would take 20 times the latency.
+        self.assertLess(duration, LATENCY_S * 5)
+
+    def test_skips_slow_quotes_until_done(self):
+        release = threading.Event()
+        get_fast_price = get_stub_price_source({})
+
+        def get_price(ticker_symbol):
+            if ticker_symbol == "SLOW":
+                release.wait()
+
+            return get_fast_price(ticker_symbol)
+
+        ticker_symbols = ("SLOW",) + TICKER_SYMBOLS[:3]
+        pending = {}
+
+        start = time.monotonic()
+        stock_infos = finance_scraper.fetch_all_stock_info(self.executor, len(TICKER_SYMBOLS), pending, ticker_symbols, get_price, LATENCY_S * 3)
+        duration = time.monotonic() - start
+
+        self.assertEqual(sorted(stock_info.symbol for stock_info in stock_infos), sorted(TICKER_SYMBOLS[:3]))
+        self.assertEqual(list(pending), ["SLOW"])
+        self.assertLess(duration, LATENCY_S * 5)
+
+        # Still hanging, so it isn't fetched a second time.
+        stock_infos = finance_scraper.fetch_all_stock_info(self.executor, len(TICKER_SYMBOLS), pending, ticker_symbols, get_price, LATENCY_S * 3)
+        self.assertNotIn("SLOW", [stock_info.symbol for stock_info in stock_infos])
+
+        release.set()
+        pending["SLOW"].result()
+
+        stock_infos = finance_scraper.fetch_all_stock_info(self.executor, len(TICKER_SYMBOLS), pending, ticker_symbols, get_price, LATENCY_S * 3)
+        self.assertIn("SLOW", [stock_info.symbol for stock_info in stock_infos])
+        self.assertEqual(pending, {})
+
+    def test_times_fetches_from_their_start(self):
+        # The reviewer's case: many more symbols than threads, fast quotes,
+        # and a timeout shorter than the whole sweep.
+        executor = concurrent.futures.ThreadPoolExecutor(4)
+        self.addCleanup(executor.shutdown)
+
+        ticker_symbols = tuple("SYM{}".format(idx) for idx in range(40))
+        get_price = get_stub_price_source({}, default_latency=0.05)
+        pending = {}
+
+        for sweep in range(3):
+            stock_infos = finance_scraper.fetch_all_stock_info(executor, 4, pending, ticker_symbols, get_price, 0.2)
+
+            self.assertEqual(sorted(stock_info.symbol for stock_info in stock_infos), sorted(ticker_symbols))
+            self.assertEqual(pending, {})
+
+    def test_skips_symbols_while_all_threads_hang(self):
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+
+        release = threading.Event()
+        get_fast_price = get_stub_price_source({}, default_latency=0)
+
+        def get_price(ticker_symbol):
+            if ticker_symbol.startswith("SLOW"):
+                release.wait()
+
+            return get_fast_price(ticker_symbol)
+
+        ticker_symbols = ("SLOW0", "SLOW1") + TICKER_SYMBOLS[:3]
+        pending = {}
+
+        stock_infos = finance_scraper.fetch_all_stock_info(executor, 2, pending, ticker_symbols, get_price, LATENCY_S)
+
+        # The symbols that never got a thread are not parked in pending.
+        self.assertEqual(stock_infos, [])
+        self.assertEqual(sorted(pending), ["SLOW0", "SLOW1"])
+
+        release.set()
+
+        for future in pending.values():
+            future.result()
+
+        stock_infos = finance_scraper.fetch_all_stock_info(executor, 2, pending, ticker_symbols, get_price, LATENCY_S)
+
+        self.assertEqual(sorted(stock_info.symbol for stock_info in stock_infos), sorted(ticker_symbols))
+        self.assertEqual(pending, {})
+
+    def test_logs_failed_quotes(self):
+        def get_price(ticker_symbol):
+            if ticker_symbol == "BROKEN":
+                raise IOError("connection reset")
+
+            return "100.5"
+
+        pending = {}
+        stock_infos = finance_scraper.fetch_all_stock_info(self.executor, len(TICKER_SYMBOLS), pending, ("BROKEN", "AAPL"), get_price, 5)
+
+        self.assertEqual([stock_info.symbol for stock_info in stock_infos], ["AAPL"])
+        self.assertEqual(pending, {})
+
+
+def get_bulk_results(statuses):
+    # Stands in for elasticsearch.helpers.streaming_bulk(), one status per action.
+    def streaming_bulk(client, actions, **kwargs):
+        for action, status in zip(actions, statuses):
+            yield 200 <= status < 300, {"index": {"status": status}}
+
+    return streaming_bulk
+
+
+class FlushSpoolTest(unittest.TestCase):
+    def setUp(self):
+        spool = tempfile.TemporaryDirectory()
+        self.addCleanup(spool.cleanup)
+        self.spool_dir = spool.name
+
+        for sequence in range(3):
+            actions = [{"ticker_symbol": "SYM{}".format(idx), "sequence": sequence} for idx in range(2)]
+            finance_scraper.spool_batch(self.spool_dir, sequence, actions)
+
+    def flush_spool(self, statuses):
+        with unittest.mock.patch.object(finance_scraper.elasticsearch.helpers, "streaming_bulk", get_bulk_results(statuses)):
+            return finance_scraper.flush_spool(None, self.spool_dir)
+
+    def get_spooled_actions(self):
+        actions = []
+
+        for filename in finance_scraper.get_spool_filenames(self.spool_dir):
+            with open(filename) as fh:
+                actions.extend(finance_scraper.json.load(fh))
+
+        return actions
+
+    def test_removes_saved_batches(self):
+        self.assertTrue(self.flush_spool([201] * 6))
+        self.assertEqual(self.get_spooled_actions(), [])
+        self.assertIsNone(self.flush_spool([]))
+
+    def test_keeps_rejected_quotes_spooled(self):
+        self.assertFalse(self.flush_spool([201, 429, 201, 201, 503, 201]))
+        self.assertEqual(self.get_spooled_actions(), [
+            {"ticker_symbol": "SYM1", "sequence": 0},
+            {"ticker_symbol": "SYM0", "sequence": 2},
+        ])
+
+        # Rejected quotes are sent before anything spooled later.
+        finance_scraper.spool_batch(self.spool_dir, 3, [{"ticker_symbol": "SYM0", "sequence": 3}])
+        self.assertEqual(self.get_spooled_actions()[0], {"ticker_symbol": "SYM1", "sequence": 0})
+
+        self.assertTrue(self.flush_spool([201] * 3))
+        self.assertEqual(self.get_spooled_actions(), [])
+
+    def test_drops_invalid_quotes(self):
+        self.assertTrue(self.flush_spool([201, 400, 201, 201, 201, 201]))
+        self.assertEqual(self.get_spooled_actions(), [])
+
+    def test_moves_corrupt_batches_aside(self):
+        filename = finance_scraper.get_spool_filenames(self.spool_dir)[1]
+
+        with open(filename, "w") as fh:
+            fh.write('[{"ticker_symbol": ')
+
+        self.assertTrue(self.flush_spool([201] * 4))
+        self.assertEqual(self.get_spooled_actions(), [])
+        self.assertTrue(os.path.exists(filename + finance_scraper.SPOOL_CORRUPT_SUFFIX))
+
+    def test_drops_oldest_batches_when_full(self):
+        finance_scraper.trim_spool(self.spool_dir, 1)
+
+        self.assertEqual(self.get_spooled_actions(), [
+            {"ticker_symbol": "SYM0", "sequence": 2},
+            {"ticker_symbol": "SYM1", "sequence": 2},
+        ])
+
+    def test_writer_survives_errors(self):
+        def streaming_bulk(client, actions, **kwargs):
+            raise OSError("disk on fire")
+
+        batches = finance_scraper.queue.Queue()
+
+        with unittest.mock.patch.object(finance_scraper.elasticsearch.helpers, "streaming_bulk", streaming_bulk):
+            with unittest.mock.patch.object(finance_scraper, "RETRY_DELAY_SECONDS", 0.01):
+                writer = finance_scraper.start_writer(None, batches, self.spool_dir, 10)
+                batches.put([{"ticker_symbol": "SYM0", "sequence": 3}])
+                time.sleep(0.1)
+
+                self.assertTrue(writer.is_alive())
+                self.assertEqual(len(self.get_spooled_actions()), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()